@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""Bulk dataset loading for ETL jobs."""
+
+import logging
+import time
+
+import ckan.lib.search as search_lib
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+
+from ckanext.extrafields import export, metrics, search
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 100
+
+# Set in the context of the per-dataset actions run by a bulk upsert, so
+# that the chained actions leave the export to it.
+DEFER_EXPORT = 'extrafields.defer_export'
+# Makes the dataset form raise validation errors before the core actions
+# roll back the session.
+RAISE_INVALID = 'extrafields.raise_invalid'
+
+
+def chunk_size():
+    return tk.asint(tk.config.get('ckanext.extrafields.bulk_chunk_size',
+                                  DEFAULT_CHUNK_SIZE))
+
+
+def extrafields_bulk_upsert_auth(context, data_dict):
+    # Sysadmins only; they skip auth functions altogether.
+    return {'success': False,
+            'msg': tk._('Only sysadmins can bulk load datasets')}
+
+
+def extrafields_bulk_upsert(context, data_dict):
+    """Create or update many datasets in a few transactions.
+
+    :param datasets: dataset dicts as for ``package_create``; those whose
+        ``id`` or ``name`` matches an existing dataset are passed to
+        ``package_update`` instead (a full update, not a patch)
+    :type datasets: list of dicts
+    :param chunk_size: datasets per database transaction (optional, default:
+        ``ckanext.extrafields.bulk_chunk_size`` or 100)
+    :type chunk_size: int
+
+    Each dataset is validated and saved inside its own savepoint, so an
+    invalid one is reported without affecting the rest of its chunk. Every
+    chunk is committed to the database and
+    to the search index once and then exported, one pass per dataset; if
+    that commit fails the chunk's datasets are reported as failed and the
+    next chunk carries on. For a single Solr commit per chunk set
+    ``ckan.search.solr_commit = false``.
+
+    :returns: ``results``, one dict per dataset in input order with
+        ``success``, ``name`` and either ``id`` and ``action``
+        (``'created'`` or ``'updated'``) or ``error``, and the ``created``,
+        ``updated`` and ``failed`` totals
+    :rtype: dictionary
+    """
+    tk.check_access('extrafields_bulk_upsert', context, data_dict)
+    datasets = data_dict.get('datasets')
+    if not isinstance(datasets, list) or not all(
+            isinstance(dataset, dict) for dataset in datasets):
+        raise tk.ValidationError(
+            {'datasets': [tk._('Must be a list of dataset dicts')]})
+    size = data_dict.get('chunk_size')
+    try:
+        size = tk.asint(chunk_size() if size is None else size)
+    except (TypeError, ValueError):
+        size = 0
+    if size < 1:
+        raise tk.ValidationError(
+            {'chunk_size': [tk._('Must be a positive integer')]})
+
+    results = []
+    for start in range(0, len(datasets), size):
+        results.extend(_upsert_chunk(context, datasets[start:start + size]))
+
+    totals = {'created': 0, 'updated': 0, 'failed': 0}
+    for result in results:
+        totals[result['action'] if result['success'] else 'failed'] += 1
+    return dict(totals, results=results)
+
+
+def _item_context(context):
+    return {
+        'model': model,
+        'session': model.Session,
+        'user': context.get('user'),
+        'auth_user_obj': context.get('auth_user_obj'),
+        'ignore_auth': context.get('ignore_auth', False),
+        'defer_commit': True,
+        DEFER_EXPORT: True,
+        RAISE_INVALID: True,
+    }
+
+
+def _upsert_chunk(context, datasets):
+    started = time.perf_counter()
+    results = []
+    saved = []
+    for dataset in datasets:
+        item_context = _item_context(context)
+        existing = model.Package.get(dataset.get('id') or dataset.get('name'))
+        if existing is not None:
+            dataset = dict(dataset, id=existing.id)
+
+        action = 'updated' if existing is not None else 'created'
+        savepoint = model.Session.begin_nested()
+        try:
+            result = tk.get_action(
+                'package_update' if existing is not None
+                else 'package_create')(item_context, dataset)
+            savepoint.commit()
+        except Exception as e:
+            # Validation errors, including the spatial check in our chained
+            # actions, are raised before the core action has touched the
+            # session (see ExampleIDatasetFormPlugin.validate).
+            savepoint.rollback()
+            error = getattr(e, 'error_dict', None) or {'message': str(e)}
+            results.append({'success': False, 'name': dataset.get('name'),
+                            'error': error})
+            continue
+        saved.append((result, action))
+        results.append({'success': True, 'id': result['id'],
+                        'name': result['name'], 'action': action})
+
+    # One database commit, which also reindexes the chunk's datasets.
+    try:
+        model.repo.commit()
+    except Exception as e:
+        # Nothing in this chunk was saved, but earlier chunks were.
+        model.Session.rollback()
+        log.error(f"Bulk upsert chunk failed to commit: {e}")
+        _restore_index(saved)
+        error = {'message': f'Chunk failed to commit: {e}'}
+        results = [
+            result if not result['success'] else
+            {'success': False, 'name': result['name'], 'error': error}
+            for result in results]
+        saved = []
+    else:
+        try:
+            search_lib.commit()
+        except Exception as e:
+            # The datasets are saved and indexed, Solr will make them
+            # visible on its next commit.
+            log.error(f"Bulk upsert chunk failed to commit Solr: {e}")
+
+    for result, action in saved:
+        export.export_dataset(result, 'create' if action == 'created'
+                              else 'update')
+    if saved:
+        search.invalidate_facet_counts()
+
+    metrics.incr('bulk.saved', len(saved))
+    metrics.incr('bulk.failed', len(results) - len(saved))
+    metrics.observe('bulk.chunk', time.perf_counter() - started)
+    log.info(f"Bulk upsert chunk: {len(saved)} saved, "
+             f"{len(results) - len(saved)} failed in "
+             f"{(time.perf_counter() - started) * 1000:.0f}ms")
+    return results
+
+
+def _restore_index(saved):
+    """Undo the search index updates of a chunk that was rolled back."""
+    for result, action in saved:
+        try:
+            if action == 'created':
+                search_lib.clear(result['id'])
+            else:
+                search_lib.rebuild(result['id'])
+        except Exception as e:
+            log.error(f"Could not restore the search index of dataset "
+                      f"{result['id']}: {e}")
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Terria catalog index of the resources flagged for the map."""
+
+import contextlib
+import fcntl
+import json
+import os
+
+CATALOG_FILENAME = 'terria-catalog.json'
+
+# Resource fields copied into the catalog.
+RESOURCE_FIELDS = ('id', 'name', 'url', 'format', 'point_or_polygon',
+                   'census_geo_year_code')
+
+
+class Catalog(object):
+    """One JSON file listing every ``terria_catalogue == 'yes'`` resource.
+
+    Resources are grouped by dataset and then by ``resource_year_code``.
+    Each dataset's entry is kept in the export index and only recomputed
+    when that dataset changes; the file itself is assembled from the stored
+    entries without parsing them. ``render`` should be called with ``lock``
+    held, so concurrent writers can't replace a newer file with an older one.
+    """
+
+    def __init__(self, directory, export_index):
+        self.path = os.path.join(directory, CATALOG_FILENAME)
+        self._lock_path = os.path.join(directory, '.catalog.lock')
+        self._index = export_index
+
+    def entry(self, dataset_dict):
+        """Return the catalog entry for ``dataset_dict``, or None."""
+        years = {}
+        for resource in dataset_dict.get('resources', []):
+            if resource.get('terria_catalogue') != 'yes':
+                continue
+            item = {field: resource.get(field) for field in RESOURCE_FIELDS}
+            item['file'] = self._index.filename_for(resource.get('id'))
+            year = resource.get('resource_year_code') or 'unknown'
+            years.setdefault(year, []).append(item)
+        if not years:
+            return None
+        return {
+            'id': dataset_dict.get('id'),
+            'name': dataset_dict.get('name'),
+            'title': dataset_dict.get('title', 'Untitled Dataset'),
+            'years': {year: years[year] for year in sorted(years)},
+        }
+
+    def _store(self, dataset_id, entry):
+        """Save ``entry``, returning False if the stored one is the same."""
+        if entry is None:
+            if self._index.catalog_entry(dataset_id) is None:
+                return False
+            self._index.drop_catalog_entry(dataset_id)
+            return True
+        encoded = json.dumps(entry, separators=(',', ':'), ensure_ascii=False)
+        if self._index.catalog_entry(dataset_id) == encoded:
+            return False
+        self._index.set_catalog_entry(dataset_id, entry['title'], encoded)
+        return True
+
+    def update(self, dataset_dict):
+        """Store the dataset's entry; returns True if the catalog changed."""
+        return self._store(dataset_dict.get('id'), self.entry(dataset_dict))
+
+    def remove_resources(self, dataset_id, resource_ids):
+        """Drop resources from a dataset's entry; True if anything changed."""
+        stored = self._index.catalog_entry(dataset_id)
+        if stored is None:
+            return False
+        entry = json.loads(stored)
+        resource_ids = set(resource_ids)
+        years = {}
+        for year, items in entry['years'].items():
+            items = [item for item in items if item['id'] not in resource_ids]
+            if items:
+                years[year] = items
+        entry['years'] = years
+        return self._store(dataset_id, entry if years else None)
+
+    def rename_files(self, renamed):
+        """Apply ``{old path: new path}`` to the files in every entry."""
+        for stored in self._index.catalog_entries():
+            entry = json.loads(stored)
+            changed = False
+            for items in entry['years'].values():
+                for item in items:
+                    if item.get('file') in renamed:
+                        item['file'] = renamed[item['file']]
+                        changed = True
+            if changed:
+                self._store(entry['id'], entry)
+
+    @contextlib.contextmanager
+    def lock(self):
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def render(self):
+        """Return the catalog file's contents."""
+        return ('{"datasets":[' + ','.join(self._index.catalog_entries())
+                + ']}').encode('utf-8')
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import click
+
+
+def get_commands():
+    return [extrafields]
+
+
+@click.group()
+def extrafields():
+    """ckanext-extrafields maintenance commands."""
+    pass
+
+
+@extrafields.command(u'init-vocabs')
+def init_vocabs():
+    """Create the extrafields tag vocabularies and any missing tags.
+
+    Safe to run on every deploy: vocabularies that already exist are left
+    alone.
+    """
+    from ckanext.extrafields.plugin import seed_vocabularies
+
+    added = seed_vocabularies()
+    click.secho(u'Vocabularies are in place ({} tags added)'.format(added),
+                fg=u'green')
+
+
+@extrafields.command(u'export')
+@click.option(u'--workers', default=4, show_default=True,
+              help=u'Number of writer threads.')
+@click.option(u'--page-size', default=500, show_default=True,
+              help=u'Datasets fetched per package_search call.')
+@click.option(u'--prune/--no-prune', default=True, show_default=True,
+              help=u'Remove exported files that match no current resource.')
+def export_all(workers, page_size, prune):
+    """Rebuild the resource JSON export from every dataset.
+
+    Unchanged files are left alone, so this is also cheap to run as a
+    periodic reconciliation.
+    """
+    import ckan.plugins.toolkit as tk
+    from ckanext.extrafields import export
+
+    site_user = tk.get_action(u'get_site_user')({u'ignore_auth': True}, {})
+    context = {u'ignore_auth': True, u'user': site_user[u'name']}
+
+    def progress(summary):
+        click.echo(u'{} datasets exported...'.format(summary[u'datasets']))
+
+    summary = export.export_all(context, workers=workers,
+                                page_size=page_size, prune=prune,
+                                progress=progress)
+
+    elapsed = summary[u'elapsed']
+    files = sum(summary.get(key, 0) for key in (u'written', u'skipped',
+                                                 u'failed'))
+    click.echo(u'Exported {} datasets ({} files) in {:.1f}s, '
+               u'{:.0f} files/s'.format(summary.get(u'datasets', 0), files,
+                                       elapsed, files / elapsed
+                                       if elapsed else 0))
+    click.echo(u'  written:   {}'.format(summary.get(u'written', 0)))
+    click.echo(u'  unchanged: {}'.format(summary.get(u'skipped', 0)))
+    click.echo(u'  removed:   {}'.format(summary.get(u'removed', 0)))
+    if summary.get(u'failed'):
+        click.secho(u'  failed:    {}'.format(summary[u'failed']), fg=u'red')
+        raise click.exceptions.Exit(1)
+
+
+@extrafields.command(u'migrate-layout')
+@click.option(u'--layout', type=click.Choice([u'flat', u'hashed', u'dataset']),
+              help=u'Layout to move to (default: the configured one).')
+def migrate_layout(layout):
+    """Move the exported files into the export directory layout.
+
+    Run this after changing ckanext.extrafields.export.layout.
+    """
+    from ckanext.extrafields import export
+
+    moved = export.migrate_layout(layout)
+    click.secho(u'Moved {} files to the {} layout'.format(
+        moved, layout or export.export_layout()), fg=u'green')
@@ -0,0 +1,1048 @@
+# -*- coding: utf-8 -*-
+"""Export of resource metadata to per-resource JSON files in SHARED_DIR."""
+
+import atexit
+import collections
+import contextlib
+import copy
+import datetime
+import fcntl
+import functools
+import gzip
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import ckan.plugins.toolkit as tk
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from ckanext.extrafields import metrics
+from ckanext.extrafields.catalog import CATALOG_FILENAME, Catalog
+from ckanext.extrafields.index import get_index
+from ckanext.extrafields.journal import (
+    DEFAULT_KEEP, DEFAULT_MAX_BYTES, JOURNAL_DIRNAME, Journal)
+
+log = logging.getLogger(__name__)
+
+SHARED_DIR = '/shared/allJsons'
+
+DEFAULT_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 1000
+# Seconds between warnings while a request waits for room in a full queue.
+QUEUE_FULL_WARN_AFTER = 10
+
+EXPORT_FORMATS = ('pretty', 'compact')
+DEFAULT_EXPORT_FORMAT = 'pretty'
+
+# flat: every file directly in SHARED_DIR; hashed: spread over 256
+# subdirectories by a hash of the file name; dataset: one subdirectory per
+# dataset title.
+EXPORT_LAYOUTS = ('flat', 'hashed', 'dataset')
+DEFAULT_EXPORT_LAYOUT = 'flat'
+HASHED_SHARDS = 256
+
+
+_UNSAFE_CHARS = re.compile(r'[^a-zA-Z0-9\-_\.]')
+_UNDERSCORE_RUNS = re.compile(r'_+')
+
+# Every save derives file names from the same few titles and year codes,
+# so remember the most recent ones.
+SANITIZE_CACHE_SIZE = 4096
+
+
+def sanitize_filename(text):
+    """Convert any string into safe filename (alphanumeric + underscore/dash)."""
+    if not isinstance(text, str):
+        text = str(text)
+    return _sanitize(text)
+
+@functools.lru_cache(maxsize=SANITIZE_CACHE_SIZE)
+def _sanitize(text):
+    safe = _UNSAFE_CHARS.sub('_', text.strip())
+    safe = _UNDERSCORE_RUNS.sub('_', safe)
+    # No leading dots: they would make hidden files, or '..'.
+    safe = safe.lstrip('._').rstrip('_')
+    return safe if safe else 'untitled'
+
+def export_format():
+    fmt = tk.config.get('ckanext.extrafields.export.format',
+                        DEFAULT_EXPORT_FORMAT)
+    if fmt not in EXPORT_FORMATS:
+        log.warning(f"Unknown ckanext.extrafields.export.format value "
+                    f"{fmt!r}, using {DEFAULT_EXPORT_FORMAT!r}")
+        fmt = DEFAULT_EXPORT_FORMAT
+    return fmt
+
+def gzip_enabled():
+    return tk.asbool(tk.config.get('ckanext.extrafields.export.gzip', False))
+
+def export_extension():
+    return '.json.gz' if gzip_enabled() else '.json'
+
+def export_layout():
+    layout = tk.config.get('ckanext.extrafields.export.layout',
+                           DEFAULT_EXPORT_LAYOUT)
+    if layout not in EXPORT_LAYOUTS:
+        log.warning(f"Unknown ckanext.extrafields.export.layout value "
+                    f"{layout!r}, using {DEFAULT_EXPORT_LAYOUT!r}")
+        layout = DEFAULT_EXPORT_LAYOUT
+    return layout
+
+def shard_path(basename, layout=None):
+    """Return the path of ``basename`` relative to SHARED_DIR.
+
+    The subdirectory only depends on the name itself, so any file can be
+    located without listing directories or asking the index.
+    """
+    layout = layout or export_layout()
+    if layout == 'hashed':
+        shard = zlib.crc32(basename.encode('utf-8')) % HASHED_SHARDS
+        return f"{shard:02x}/{basename}"
+    if layout == 'dataset':
+        # Sanitised titles never contain '__', the year part follows it.
+        title = basename.partition('__')[0]
+        if title == basename or title.endswith('.manifest'):
+            title = title.rpartition('.manifest')[0] or title
+        # Names written before titles lost their leading dots can still
+        # start with one; don't let them escape SHARED_DIR or hide.
+        title = title.lstrip('.') or 'untitled'
+        return f"{title}/{basename}"
+    return basename
+
+def get_resource_filename(dataset_title, resource):
+    """Generate filename: {DatasetTitle}__{resource_year_code}.json
+
+    The extension is ``.json.gz`` when gzip export is enabled, and the name
+    is prefixed with its subdirectory in the hashed and dataset layouts.
+    """
+    year_code = resource.get('resource_year_code', 'unknown')  # ← YOUR FIELD NAME
+    title_part = sanitize_filename(dataset_title)
+    year_part = sanitize_filename(year_code)
+    return shard_path(f"{title_part}__{year_part}{export_extension()}")
+
+def encode_payload(data, fmt=None, compress=None):
+    """Serialise an export payload as configured.
+
+    orjson is used when it is installed, falling back to the standard
+    library for anything it can't encode.
+    """
+    fmt = fmt or export_format()
+    compress = gzip_enabled() if compress is None else compress
+    encoded = None
+    if orjson is not None:
+        try:
+            encoded = orjson.dumps(
+                data, option=orjson.OPT_INDENT_2 if fmt == 'pretty' else 0)
+        except TypeError:
+            pass
+    if encoded is None:
+        if fmt == 'pretty':
+            text = json.dumps(data, indent=2, ensure_ascii=False)
+        else:
+            text = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+        encoded = text.encode('utf-8')
+    if compress:
+        # mtime=0 keeps the output stable for identical content.
+        encoded = gzip.compress(encoded, mtime=0)
+    return encoded
+
+# Payload fields that change on every save without the content changing.
+VOLATILE_FIELDS = ('timestamp', 'action')
+
+def content_hash(data):
+    """Hash an export payload, ignoring its ``VOLATILE_FIELDS``."""
+    stable = {k: v for k, v in data.items() if k not in VOLATILE_FIELDS}
+    encoded = json.dumps(stable, sort_keys=True, separators=(',', ':'),
+                         ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+def skip_unchanged():
+    return tk.asbool(tk.config.get(
+        'ckanext.extrafields.export.skip_unchanged', True))
+
+# ================================
+# ATOMIC WRITES
+# ================================
+
+# How hard we try to get exported files onto disk before they replace the
+# old ones: 'file' fsyncs every file and the directory after each rename,
+# 'batch' fsyncs all of a dataset's files before renaming them and then each
+# directory once, and 'none' leaves it to the OS.  Files are always replaced
+# atomically, so readers never see a partial file in any mode.
+DURABILITY_MODES = ('file', 'batch', 'none')
+DEFAULT_DURABILITY = 'none'
+
+
+def durability():
+    mode = tk.config.get('ckanext.extrafields.export.fsync',
+                         DEFAULT_DURABILITY)
+    if mode not in DURABILITY_MODES:
+        log.warning(f"Unknown ckanext.extrafields.export.fsync value "
+                    f"{mode!r}, using {DEFAULT_DURABILITY!r}")
+        mode = DEFAULT_DURABILITY
+    return mode
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteBatch(object):
+    """Atomically replaces a group of files.
+
+    Each file is written to a hidden temporary file next to its target and
+    moved into place with ``os.replace``. Outside 'batch' mode every write is
+    committed straight away; in 'batch' mode the renames wait for
+    ``commit()`` so that all the data is on disk before any file changes.
+    ``on_commit`` callbacks run once their file is in place.
+    """
+
+    def __init__(self, mode=None):
+        self.mode = mode or durability()
+        self._pending = []
+        # Journal entries for the files this batch wrote or replaced.
+        self.events = []
+        # {file name: owner id} of the files staged but not yet committed,
+        # which the export index only learns about on commit.
+        self.claims = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def write(self, filepath, data, on_commit=None):
+        directory, basename = os.path.split(filepath)
+        fd, tmp = tempfile.mkstemp(
+            dir=directory, prefix=f'.{basename}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                if self.mode == 'file':
+                    f.flush()
+                    os.fsync(f.fileno())
+                    metrics.incr('export.fsyncs')
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._pending.append((tmp, filepath, on_commit))
+        if self.mode != 'batch':
+            self.commit()
+
+    def commit(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        if self.mode == 'batch':
+            for tmp, _, _ in pending:
+                _fsync_path(tmp)
+                metrics.incr('export.fsyncs')
+        for tmp, filepath, on_commit in pending:
+            try:
+                os.replace(tmp, filepath)
+            except OSError as e:
+                log.error(f"❌ Failed to write {filepath}: {e}")
+                _unlink_quietly(tmp)
+                continue
+            if on_commit is not None:
+                on_commit()
+        if self.mode != 'none':
+            for directory in {os.path.dirname(p) for _, p, _ in pending}:
+                _fsync_path(directory)
+                metrics.incr('export.fsyncs')
+
+    def abort(self):
+        pending, self._pending = self._pending, []
+        for tmp, _, _ in pending:
+            _unlink_quietly(tmp)
+
+
+def _unlink_quietly(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+# ================================
+# CONCURRENT WRITERS
+# ================================
+
+LOCKS_DIRNAME = '.locks'
+# Datasets are spread over this many lock files, so unrelated datasets
+# rarely wait for each other and the number of lock files stays bounded.
+LOCK_STRIPES = 256
+
+_stripe_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+
+@contextlib.contextmanager
+def dataset_lock(dataset_id):
+    """Hold the export lock of ``dataset_id``.
+
+    The lock is a POSIX record lock on a file under ``SHARED_DIR/.locks``,
+    which serialises writers in other processes and, on a shared filesystem
+    with working locks (NFS with lockd), on other nodes. POSIX locks don't
+    exclude threads of the same process, hence the matching thread lock.
+    """
+    stripe = zlib.crc32((dataset_id or '').encode('utf-8')) % LOCK_STRIPES
+    directory = os.path.join(SHARED_DIR, LOCKS_DIRNAME)
+    os.makedirs(directory, exist_ok=True)
+    started = time.perf_counter()
+    with _stripe_locks[stripe]:
+        with open(os.path.join(directory, f'{stripe:03d}.lock'), 'a') as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            metrics.observe('export.lock_wait', time.perf_counter() - started)
+            try:
+                yield
+            finally:
+                fcntl.lockf(f, fcntl.LOCK_UN)
+
+
+def last_modified(dataset_dict, resource=None):
+    """The ``metadata_modified`` that orders exports of ``resource``.
+
+    Payloads carry dataset fields too, so the dataset's timestamp counts
+    as well as the resource's; the later of the two is used.
+    """
+    values = [value for value in (
+        (resource or {}).get('metadata_modified'),
+        dataset_dict.get('metadata_modified')) if value]
+    return max(values) if values else None
+
+
+# Fields derived from the dataset's spatial extra that consumers can use
+# instead of parsing the full geometry.
+HEADER_SPATIAL_FIELDS = ('spatial_bbox', 'spatial_centroid')
+
+def dataset_header(dataset_dict, action):
+    """The part of an export payload shared by all of a dataset's files."""
+    dataset = {
+        'id': dataset_dict.get('id'),
+        'name': dataset_dict.get('name'),
+        'title': dataset_dict.get('title', 'Untitled Dataset'),
+    }
+    for field in HEADER_SPATIAL_FIELDS:
+        if dataset_dict.get(field):
+            try:
+                dataset[field] = json.loads(dataset_dict[field])
+            except (TypeError, ValueError):
+                pass
+    return {
+        'dataset': dataset,
+        'action': action,
+        'timestamp': datetime.datetime.utcnow().isoformat()
+    }
+
+def write_resource_json(dataset_dict, resource, action, batch=None,
+                        header=None):
+    """Write one JSON file per resource.
+
+    The file is replaced atomically through ``batch`` (or a batch of its own
+    if none is given), so in 'batch' mode it only appears once the batch is
+    committed. ``header`` is the dataset's ``dataset_header``; when writing
+    several resources pass it in so it is only built once.
+
+    Returns ``'written'``, ``'skipped'`` (the file already holds the same
+    content), ``'stale'`` (a newer version was already written) or None if
+    the write failed.
+    """
+    if batch is None:
+        os.makedirs(SHARED_DIR, exist_ok=True)
+        with dataset_lock(dataset_dict.get('id')), WriteBatch() as batch:
+            outcome = write_resource_json(dataset_dict, resource, action,
+                                          batch, header)
+        record_events(batch.events)
+        return outcome
+    if header is None:
+        header = dataset_header(dataset_dict, action)
+
+    data_to_write = {
+        'dataset': header['dataset'],
+        'resource': resource,
+        'action': header['action'],
+        'timestamp': header['timestamp'],
+    }
+    filename = get_resource_filename(header['dataset']['title'], resource)
+    return _write_export_file(batch, filename, resource.get('id'),
+                              dataset_dict.get('id'), data_to_write,
+                              last_modified(dataset_dict, resource))
+
+def _write_export_file(batch, filename, owner_id, dataset_id, data_to_write,
+                       modified=None):
+    """Stage ``data_to_write`` in ``batch`` as the file owned by ``owner_id``.
+
+    ``owner_id`` is a resource id (or the manifest key of a dataset) and is
+    used to follow the file across renames and to detect collisions.
+    ``modified`` is the ``metadata_modified`` of the data; a payload older
+    than the one already exported for ``owner_id`` is dropped as
+    ``'stale'``. Callers hold the dataset's ``dataset_lock``.
+    """
+    filepath = os.path.join(SHARED_DIR, filename)
+    started = time.perf_counter()
+    try:
+        export_index = get_index(SHARED_DIR)
+        previous = None
+        if owner_id:
+            exported = export_index.modified_for(owner_id)
+            deleted = export_index.deleted_at(owner_id)
+            if modified and exported and modified < exported:
+                metrics.incr('export.files.stale')
+                log.debug(f"Dropped export of {owner_id} from {modified}, "
+                          f"{exported} was already written")
+                return 'stale'
+            if modified and deleted and modified <= deleted:
+                metrics.incr('export.files.stale')
+                log.debug(f"Dropped export of {owner_id} from {modified}, "
+                          f"it was deleted at {deleted}")
+                return 'stale'
+            previous = export_index.filename_for(owner_id)
+            filename = _claim_filename(
+                export_index, filename, owner_id, batch.claims)
+            filepath = os.path.join(SHARED_DIR, filename)
+
+        def assign():
+            # Only once the file is in place, so a failed write leaves
+            # neither a dangling entry nor a reserved name.
+            if owner_id:
+                export_index.assign(owner_id, dataset_id, filename, modified)
+
+        def renamed():
+            # The dataset was renamed or the year code changed: the file
+            # under the old name is now stale.
+            if previous and previous != filename \
+                    and export_index.owner_of(previous) is None:
+                _remove_export_file(export_index, previous)
+                metrics.incr('export.files.renamed')
+                batch.events.append(_journal_event(
+                    'delete', previous, dataset_id, owner_id))
+
+        fmt = export_format()
+        # Switching format has to rewrite files even if the content is the same.
+        digest = f"{fmt}:{content_hash(data_to_write)}"
+        if skip_unchanged():
+            known = export_index.get(filename)
+            if known and known[0] == digest and os.path.exists(filepath):
+                assign()
+                renamed()
+                metrics.incr('export.files.skipped')
+                metrics.incr('export.bytes_saved', known[1])
+                log.debug(f"Resource JSON unchanged, skipped: {filepath}")
+                metrics.observe('export.file_check',
+                                time.perf_counter() - started)
+                return 'skipped'
+
+        encoded = encode_payload(data_to_write, fmt)
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        # The journal says whether the file itself is new: an updated
+        # dataset can gain resources, and a renamed file is a new one.
+        event = data_to_write['action']
+        if owner_id:
+            event = 'update' if previous == filename else 'create'
+
+        def written():
+            assign()
+            export_index.set(filename, digest, len(encoded))
+            renamed()
+            batch.events.append(_journal_event(
+                event, filename, dataset_id, owner_id, digest))
+            metrics.incr('export.files.written')
+            metrics.incr('export.bytes_written', len(encoded))
+            log.debug(f"✅ Resource JSON written: {filepath}")
+
+        if owner_id:
+            batch.claims[filename] = owner_id
+        batch.write(filepath, encoded, on_commit=written)
+        metrics.observe('export.file_write', time.perf_counter() - started)
+        return 'written'
+    except Exception as e:
+        log.error(f"❌ Failed to write {filepath}: {e}")
+
+def _claim_filename(export_index, filename, resource_id, claims=None):
+    """Return the name ``resource_id`` should be exported to.
+
+    If another resource already owns ``filename``, in the index or in
+    ``claims`` (the names staged by the current batch), i.e. two resources
+    have the same title and year code, the resource id is added to the
+    name, instead of one file silently overwriting the other.
+    """
+    owner = (claims or {}).get(filename) or export_index.owner_of(filename)
+    if owner is not None and owner != resource_id:
+        metrics.incr('export.files.collisions')
+        # Suffix the bare name and shard it again, as the new name may
+        # belong in another directory.
+        base = os.path.basename(filename)[:-len(export_extension())]
+        claimed = shard_path(f"{base}__{sanitize_filename(resource_id)[:8]}"
+                             f"{export_extension()}")
+        log.warning(f"Resource {resource_id} would overwrite {filename} "
+                    f"(resource {owner}), writing {claimed} instead")
+        filename = claimed
+    return filename
+
+def _remove_export_file(export_index, filename):
+    filepath = os.path.join(SHARED_DIR, filename)
+    try:
+        os.remove(filepath)
+        log.debug(f"🗑️ Deleted resource JSON: {filepath}")
+    except FileNotFoundError:
+        log.warning(f"⚠️ JSON file not found for deletion: {filepath}")
+    export_index.forget(filename)
+
+def _journal_event(event, filename, dataset_id, owner_id, digest=None):
+    return {
+        'event': event,
+        'file': filename,
+        'dataset_id': dataset_id,
+        'resource_id': owner_id,
+        # Strip the format prefix, consumers only care about the content.
+        'hash': digest.rpartition(':')[2] if digest else None,
+    }
+
+def journal_enabled():
+    return tk.asbool(tk.config.get('ckanext.extrafields.journal', False))
+
+def record_events(events):
+    """Append ``events`` to the change journal, if it is enabled."""
+    if not events or not journal_enabled():
+        return
+    try:
+        Journal(
+            os.path.join(SHARED_DIR, JOURNAL_DIRNAME), get_index(SHARED_DIR),
+            max_bytes=tk.asint(tk.config.get(
+                'ckanext.extrafields.journal.max_bytes', DEFAULT_MAX_BYTES)),
+            keep=tk.asint(tk.config.get(
+                'ckanext.extrafields.journal.keep', DEFAULT_KEEP)),
+        ).append(events)
+    except Exception as e:
+        log.error(f"❌ Failed to append to the change journal: {e}")
+
+def delete_resource_json(dataset_title, resource, dataset_id=None,
+                         modified=None):
+    """Delete corresponding JSON file for this resource.
+
+    The file is looked up by resource id in the export index, so it is found
+    even if the title or year code changed since it was written. The name
+    is only derived from ``dataset_title`` for files the index doesn't know.
+    ``modified`` is the dataset's ``metadata_modified`` after the delete;
+    exports up to then that arrive late are dropped.
+
+    Returns the journal entry for the deletion, or None if it failed.
+    """
+    filename = None
+    try:
+        export_index = get_index(SHARED_DIR)
+        if resource.get('id'):
+            filename = export_index.release(resource['id'], modified)
+        if filename is None:
+            filename = get_resource_filename(dataset_title, resource)
+        _remove_export_file(export_index, filename)
+        return _journal_event('delete', filename, dataset_id,
+                              resource.get('id'))
+    except Exception as e:
+        log.error(f"❌ Failed to delete {filename}: {e}")
+
+
+def manifest_enabled():
+    return tk.asbool(tk.config.get('ckanext.extrafields.export.manifest',
+                                   False))
+
+def manifest_key(dataset_id):
+    """The id the dataset manifest is tracked under in the export index."""
+    return f"manifest:{dataset_id}"
+
+def get_manifest_filename(dataset_title):
+    """Generate filename: {DatasetTitle}.manifest.json"""
+    return shard_path(
+        f"{sanitize_filename(dataset_title)}.manifest{export_extension()}")
+
+def write_dataset_json(dataset_dict, action, catalog=True):
+    """Export all of a dataset's resources in one pass.
+
+    The shared header (and its timestamp) is built once, the files are
+    committed as one batch and, if ``ckanext.extrafields.export.manifest``
+    is on, a combined manifest with every resource is written alongside.
+    The dataset's Terria catalog entry is then updated; with ``catalog``
+    false the catalog file itself is left for the caller to render.
+
+    Returns the outcome of each file written, as for write_resource_json.
+    """
+    started = time.monotonic()
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    header = dataset_header(dataset_dict, action)
+    resources = dataset_dict.get('resources', [])
+
+    with dataset_lock(dataset_dict.get('id')):
+        with WriteBatch() as batch:
+            outcomes = [write_resource_json(dataset_dict, resource, action,
+                                            batch, header)
+                        for resource in resources]
+            if manifest_enabled() and dataset_dict.get('id'):
+                manifest = dict(header, resources=resources)
+                outcomes.append(_write_export_file(
+                    batch, get_manifest_filename(header['dataset']['title']),
+                    manifest_key(dataset_dict['id']), dataset_dict['id'],
+                    manifest, last_modified(dataset_dict)))
+        # A newer save already updated the catalog entry.
+        if 'stale' not in outcomes:
+            update_catalog(dataset_dict, render=catalog)
+    record_events(batch.events)
+    metrics.observe('export.dataset', time.monotonic() - started)
+    if outcomes:
+        elapsed = (time.monotonic() - started) * 1000
+        log.info(
+            f"Exported dataset {dataset_dict.get('name')} in {elapsed:.1f}ms: "
+            f"{outcomes.count('written')} written, "
+            f"{outcomes.count('skipped')} unchanged, "
+            f"{outcomes.count('stale')} stale, "
+            f"{outcomes.count(None)} failed")
+    return outcomes
+
+
+@metrics.timer('export.delete')
+def _delete_dataset_json(dataset_id, dataset_title, resources, manifest,
+                         modified=None):
+    with dataset_lock(dataset_id):
+        events = [delete_resource_json(dataset_title, resource, dataset_id,
+                                       modified)
+                  for resource in resources]
+        if manifest:
+            export_index = get_index(SHARED_DIR)
+            key = manifest_key(dataset_id)
+            filename = export_index.release(key, modified)
+            if filename is not None:
+                _remove_export_file(export_index, filename)
+                events.append(_journal_event('delete', filename, dataset_id,
+                                             key))
+        remove_from_catalog(dataset_id,
+                            [resource.get('id') for resource in resources])
+    record_events([event for event in events if event])
+
+
+# ================================
+# TERRIA CATALOG
+# ================================
+
+def catalog_enabled():
+    return tk.asbool(tk.config.get('ckanext.extrafields.terria_catalog',
+                                   False))
+
+def render_catalog():
+    """Rewrite the Terria catalog file from the entries in the index."""
+    catalog = Catalog(SHARED_DIR, get_index(SHARED_DIR))
+    with catalog.lock(), WriteBatch() as batch:
+        batch.write(catalog.path, catalog.render())
+    metrics.incr('export.catalog.renders')
+
+def update_catalog(dataset_dict, render=True):
+    """Refresh the dataset's catalog entry and, if it changed, the file."""
+    if not catalog_enabled():
+        return
+    try:
+        changed = Catalog(SHARED_DIR, get_index(SHARED_DIR)).update(
+            dataset_dict)
+        if changed and render:
+            render_catalog()
+    except Exception as e:
+        log.error(f"❌ Failed to update the Terria catalog: {e}")
+
+def remove_from_catalog(dataset_id, resource_ids):
+    """Drop deleted resources from the catalog (and the file, if needed)."""
+    if not catalog_enabled():
+        return
+    try:
+        changed = Catalog(SHARED_DIR, get_index(SHARED_DIR)).remove_resources(
+            dataset_id, resource_ids)
+        if changed:
+            render_catalog()
+    except Exception as e:
+        log.error(f"❌ Failed to update the Terria catalog: {e}")
+
+
+# ================================
+# ASYNC EXPORT
+# ================================
+
+class ExportQueue(object):
+    """Bounded job queue drained by background writer threads.
+
+    Jobs are routed to a worker by key (the dataset id), so the writes and
+    deletes of one dataset always run in the order they were submitted.
+    When a worker's queue is full the caller waits for room, which slows
+    the request down rather than dropping the export or running it ahead
+    of the dataset's jobs that are still queued.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE):
+        workers = max(1, workers)
+        per_worker = max(1, queue_size // workers)
+        self._queues = [queue.Queue(per_worker) for _ in range(workers)]
+        self._threads = []
+        self._stopped = False
+        for i, q in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._run, args=(q,),
+                name=f'extrafields-export-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self, q):
+        while True:
+            job = q.get()
+            try:
+                if job is None:
+                    return
+                func, args = job
+                try:
+                    func(*args)
+                    metrics.incr('export.queue.completed')
+                except Exception as e:
+                    metrics.incr('export.queue.failed')
+                    log.error(f"Background export job failed: {e}")
+            finally:
+                q.task_done()
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def submit(self, key, func, *args):
+        if self._stopped:
+            func(*args)
+            return
+        q = self._queues[zlib.crc32(str(key).encode('utf-8')) % len(self._queues)]
+        try:
+            q.put_nowait((func, args))
+        except queue.Full:
+            metrics.incr('export.queue.overflowed')
+            started = time.perf_counter()
+            while True:
+                try:
+                    q.put((func, args), timeout=QUEUE_FULL_WARN_AFTER)
+                    break
+                except queue.Full:
+                    log.warning(
+                        f"Export queue still full after "
+                        f"{time.perf_counter() - started:.0f}s, waiting")
+            metrics.observe('export.queue.wait', time.perf_counter() - started)
+        metrics.incr('export.queue.enqueued')
+        depth = self.depth()
+        metrics.set_gauge('export.queue.depth', depth)
+        metrics.max_gauge('export.queue.max_depth', depth)
+
+    def flush(self):
+        """Block until every job submitted so far has run."""
+        for q in self._queues:
+            q.join()
+        metrics.set_gauge('export.queue.depth', 0)
+
+    def stop(self):
+        """Finish the queued jobs and stop the worker threads."""
+        if self._stopped:
+            return
+        self._stopped = True
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            thread.join()
+        metrics.set_gauge('export.queue.depth', 0)
+
+
+_export_queue = None
+_export_queue_pid = None
+_export_queue_lock = threading.Lock()
+
+
+def async_enabled():
+    return tk.asbool(tk.config.get('ckanext.extrafields.export.async', False))
+
+
+def get_export_queue():
+    """Return this process's export queue, starting it on first use.
+
+    The queue is created lazily (and again after a fork) so that pre-forking
+    servers don't end up with a queue whose threads only exist in the master.
+    """
+    global _export_queue, _export_queue_pid
+    with _export_queue_lock:
+        if _export_queue is None or _export_queue_pid != os.getpid():
+            _export_queue = ExportQueue(
+                workers=tk.asint(tk.config.get(
+                    'ckanext.extrafields.export.workers', DEFAULT_WORKERS)),
+                queue_size=tk.asint(tk.config.get(
+                    'ckanext.extrafields.export.queue_size',
+                    DEFAULT_QUEUE_SIZE)))
+            _export_queue_pid = os.getpid()
+        return _export_queue
+
+
+def shutdown():
+    """Flush and stop the export queue, if this process started one."""
+    global _export_queue
+    with _export_queue_lock:
+        export_queue, _export_queue = _export_queue, None
+        if export_queue is not None and _export_queue_pid == os.getpid():
+            export_queue.stop()
+
+
+atexit.register(shutdown)
+
+
+def _dispatch(key, func, *args):
+    if async_enabled():
+        get_export_queue().submit(key, func, *args)
+    else:
+        func(*args)
+
+
+def export_dataset(dataset_dict, action):
+    """Write the resource JSONs of a dataset (in the background if enabled)."""
+    # The caller still owns dataset_dict, so queued jobs get their own copy.
+    if async_enabled():
+        dataset_dict = copy.deepcopy(dataset_dict)
+    _dispatch(dataset_dict.get('id'), write_dataset_json, dataset_dict, action)
+
+
+def remove_dataset_exports(dataset_id, dataset_title, resources,
+                           manifest=False, modified=None):
+    """Delete the JSONs of the given resources (in the background if enabled).
+
+    With ``manifest`` the dataset's manifest is deleted as well. ``modified``
+    is the dataset's ``metadata_modified`` after the delete, if known.
+    """
+    _dispatch(dataset_id, _delete_dataset_json, dataset_id, dataset_title,
+              list(resources), manifest, modified)
+
+
+# ================================
+# BULK RE-EXPORT
+# ================================
+
+DEFAULT_PAGE_SIZE = 500
+# Temporary files older than this are left over from a crashed writer.
+STALE_TMP_AGE = 3600
+
+
+def iter_datasets(context, page_size=DEFAULT_PAGE_SIZE):
+    """Yield every active dataset, fetched ``page_size`` at a time.
+
+    Pages are keyed on the last id seen rather than an offset, so datasets
+    deleted or created while this runs can't shift others out of the
+    results.
+    """
+    last_id = None
+    while True:
+        data_dict = {
+            'q': '*:*',
+            'rows': page_size,
+            'sort': 'id asc',
+            'include_private': True,
+        }
+        if last_id is not None:
+            escaped = last_id.replace('\\', '\\\\').replace('"', '\\"')
+            data_dict['fq'] = f'id:{{"{escaped}" TO *]'
+        results = tk.get_action('package_search')(
+            context, data_dict)['results']
+        if not results:
+            return
+        for dataset in results:
+            yield dataset
+        last_id = results[-1]['id']
+
+
+def _walk(directory, prefix=''):
+    """Yield ``(relative path, entry)`` for the files under ``directory``.
+
+    Subdirectories starting with a dot (the journal, locks) are skipped.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith('.'):
+                    yield from _walk(entry.path, f"{prefix}{entry.name}/")
+            elif entry.is_file():
+                yield prefix + entry.name, entry
+
+
+def _exported_files(directory, older_than):
+    extensions = ('.json', '.json.gz')
+    for path, entry in _walk(directory):
+        if entry.name.startswith('.'):
+            continue
+        if (entry.name.endswith(extensions)
+                and entry.stat().st_mtime < older_than):
+            yield path
+
+
+def _stale_tmp_files(directory, now):
+    for path, entry in _walk(directory):
+        if (entry.name.startswith('.') and entry.name.endswith('.tmp')
+                and now - entry.stat().st_mtime > STALE_TMP_AGE):
+            yield path
+
+
+def export_all(context, workers=4, page_size=DEFAULT_PAGE_SIZE, prune=True,
+               progress=None):
+    """Rewrite the export for every dataset and optionally remove orphans.
+
+    Datasets are streamed from the search index and written by a pool of
+    ``workers`` threads; files whose content hasn't changed are skipped as
+    usual. With ``prune``, exported files that don't belong to any current
+    resource are deleted, except those written since the run started (which
+    may come from saves that raced with it). ``progress`` is called with the running summary
+    after each page. The Terria catalog, if enabled, is rendered once at the
+    end.
+
+    Returns a summary dict with counts and the elapsed time.
+    """
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    started = time.monotonic()
+    started_at = time.time()
+    summary = collections.Counter()
+    expected = {CATALOG_FILENAME}
+    seen = set()
+    datasets = set()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = []
+        for dataset in iter_datasets(context, page_size):
+            title = dataset.get('title', 'Untitled Dataset')
+            for resource in dataset.get('resources', []):
+                expected.add(get_resource_filename(title, resource))
+                seen.add(resource.get('id'))
+            if manifest_enabled():
+                seen.add(manifest_key(dataset.get('id')))
+            datasets.add(dataset.get('id'))
+            # The catalog file is rendered once at the end instead.
+            pending.append(pool.submit(write_dataset_json, dataset, 'update',
+                                       False))
+            summary['datasets'] += 1
+            if len(pending) >= page_size:
+                _collect(pending, summary)
+                if progress is not None:
+                    progress(summary)
+        _collect(pending, summary)
+
+    if prune:
+        export_index = get_index(SHARED_DIR)
+        # Forget resources that no longer exist; every name still in the
+        # index (including collision-renamed ones) is then live.
+        export_index.release_all_except(seen)
+        export_index.retain_catalog_entries(datasets)
+        expected.update(export_index.filenames())
+        events = []
+        for filename in _exported_files(SHARED_DIR, started_at):
+            if filename not in expected:
+                try:
+                    os.remove(os.path.join(SHARED_DIR, filename))
+                    export_index.forget(filename)
+                    events.append(_journal_event('delete', filename, None,
+                                                 None))
+                    summary['removed'] += 1
+                except OSError as e:
+                    log.error(f"❌ Failed to delete {filename}: {e}")
+        record_events(events)
+        for filename in _stale_tmp_files(SHARED_DIR, time.time()):
+            _unlink_quietly(os.path.join(SHARED_DIR, filename))
+
+    if catalog_enabled():
+        render_catalog()
+
+    result = dict(summary)
+    result['elapsed'] = time.monotonic() - started
+    return result
+
+
+def _collect(pending, summary):
+    for future in pending:
+        for outcome in future.result():
+            summary[outcome or 'failed'] += 1
+    del pending[:]
+
+
+# ================================
+# LAYOUT MIGRATION
+# ================================
+
+def migrate_layout(layout=None):
+    """Move every exported file to its place in ``layout``.
+
+    Defaults to the configured layout, so run it right after changing
+    ``ckanext.extrafields.export.layout``. Writers that already use the new
+    layout can keep going: a file they have written is never overwritten
+    with the old copy. The index, the journal and the Terria catalog are
+    updated to match.
+
+    Returns the number of files moved.
+    """
+    layout = layout or export_layout()
+    export_index = get_index(SHARED_DIR)
+    renamed = {}
+    events = []
+    for path, entry in list(_walk(SHARED_DIR)):
+        if (entry.name.startswith('.') or path == CATALOG_FILENAME
+                or not entry.name.endswith(('.json', '.json.gz'))):
+            continue
+        target = shard_path(entry.name, layout)
+        if target == path:
+            continue
+        target_path = os.path.join(SHARED_DIR, target)
+        try:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            try:
+                # Unlike os.replace this never clobbers the target.
+                os.link(entry.path, target_path)
+            except FileExistsError:
+                # A writer already put a newer version there.
+                export_index.forget(path)
+            os.unlink(entry.path)
+        except OSError as e:
+            log.error(f"❌ Failed to move {path} to {target}: {e}")
+            continue
+        export_index.rename_file(path, target)
+        known = export_index.get(target)
+        events.append(_journal_event('delete', path, None, None))
+        events.append(_journal_event('update', target, None, None,
+                                     known[0] if known else None))
+        renamed[path] = target
+    record_events(events)
+    if renamed:
+        Catalog(SHARED_DIR, export_index).rename_files(renamed)
+        if catalog_enabled():
+            render_catalog()
+    _remove_empty_dirs(SHARED_DIR)
+    log.info(f"Moved {len(renamed)} files to the {layout} layout")
+    return len(renamed)
+
+
+def _remove_empty_dirs(directory):
+    with os.scandir(directory) as entries:
+        subdirs = [entry.path for entry in entries
+                   if entry.is_dir(follow_symlinks=False)
+                   and not entry.name.startswith('.')]
+    for subdir in subdirs:
+        _remove_empty_dirs(subdir)
+        try:
+            os.rmdir(subdir)
+        except OSError:
+            pass
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""SQLite sidecar index kept next to the exported JSON files."""
+
+import os
+import sqlite3
+import threading
+
+INDEX_FILENAME = '.extrafields-index.sqlite3'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS resources (
+    resource_id TEXT PRIMARY KEY,
+    dataset_id TEXT,
+    filename TEXT NOT NULL,
+    modified TEXT
+);
+CREATE INDEX IF NOT EXISTS resources_filename ON resources (filename);
+CREATE TABLE IF NOT EXISTS deleted (
+    resource_id TEXT PRIMARY KEY,
+    modified TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS catalog (
+    dataset_id TEXT PRIMARY KEY,
+    title TEXT,
+    entry TEXT NOT NULL
+);
+"""
+
+
+def _migrate(conn):
+    """Bring an index created by an older version up to date."""
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(resources)')}
+    if 'modified' not in columns:
+        try:
+            with conn:
+                conn.execute('ALTER TABLE resources ADD COLUMN modified TEXT')
+        except sqlite3.OperationalError:
+            # Another process got there first.
+            pass
+
+
+class ExportIndex(object):
+    """What the exporter has written to a directory.
+
+    ``files`` holds the content hash and size of every exported file,
+    ``resources`` the file each resource is currently exported to (and the
+    ``metadata_modified`` of the version written), ``deleted`` the
+    ``metadata_modified`` at which deleted resources were removed,
+    ``sequences`` the counters used to number journal entries and
+    ``catalog`` each dataset's entry in the Terria catalog, as JSON.
+
+    Each thread gets its own connection, as sqlite3 connections can't be
+    shared between threads.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, INDEX_FILENAME)
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.executescript(_SCHEMA)
+            _migrate(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, filename):
+        """Return ``(hash, size)`` for ``filename``, or None."""
+        row = self._connect().execute(
+            'SELECT hash, size FROM files WHERE filename = ?',
+            (filename,)).fetchone()
+        return tuple(row) if row else None
+
+    def set(self, filename, content_hash, size):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO files (filename, hash, size) '
+                'VALUES (?, ?, ?)', (filename, content_hash, size))
+
+    def forget(self, filename):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM files WHERE filename = ?', (filename,))
+
+    def filename_for(self, resource_id):
+        row = self._connect().execute(
+            'SELECT filename FROM resources WHERE resource_id = ?',
+            (resource_id,)).fetchone()
+        return row[0] if row else None
+
+    def modified_for(self, resource_id):
+        """Return the ``metadata_modified`` last exported for ``resource_id``."""
+        row = self._connect().execute(
+            'SELECT modified FROM resources WHERE resource_id = ?',
+            (resource_id,)).fetchone()
+        return row[0] if row else None
+
+    def rename_file(self, old, new):
+        """Point everything recorded for file ``old`` at ``new``."""
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE OR REPLACE files SET filename = ? '
+                         'WHERE filename = ?', (new, old))
+            conn.execute('UPDATE resources SET filename = ? '
+                         'WHERE filename = ?', (new, old))
+
+    def owner_of(self, filename):
+        """Return the id of the resource exported to ``filename``, or None."""
+        row = self._connect().execute(
+            'SELECT resource_id FROM resources WHERE filename = ? LIMIT 1',
+            (filename,)).fetchone()
+        return row[0] if row else None
+
+    def assign(self, resource_id, dataset_id, filename, modified=None):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO resources '
+                '(resource_id, dataset_id, filename, modified) '
+                'VALUES (?, ?, ?, ?)',
+                (resource_id, dataset_id, filename, modified))
+            conn.execute('DELETE FROM deleted WHERE resource_id = ?',
+                         (resource_id,))
+
+    def release(self, resource_id, modified=None):
+        """Forget ``resource_id`` and return the file it was exported to.
+
+        A tombstone keeps the later of ``modified``, the time of the delete,
+        and the version last exported, see ``deleted_at``.
+        """
+        conn = self._connect()
+        with conn:
+            row = conn.execute(
+                'SELECT filename, modified FROM resources '
+                'WHERE resource_id = ?', (resource_id,)).fetchone()
+            conn.execute('DELETE FROM resources WHERE resource_id = ?',
+                         (resource_id,))
+            known = [value for value in (modified, row and row[1]) if value]
+            if known:
+                conn.execute(
+                    'INSERT OR REPLACE INTO deleted (resource_id, modified) '
+                    'VALUES (?, ?)', (resource_id, max(known)))
+        return row[0] if row else None
+
+    def deleted_at(self, resource_id):
+        """Return the ``metadata_modified`` ``resource_id`` was deleted at.
+
+        Exports of versions up to then arrived after the delete and must not
+        bring the file back.
+        """
+        row = self._connect().execute(
+            'SELECT modified FROM deleted WHERE resource_id = ?',
+            (resource_id,)).fetchone()
+        return row[0] if row else None
+
+    def release_all_except(self, resource_ids):
+        """Forget every resource not in ``resource_ids``."""
+        conn = self._connect()
+        with conn:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS keep '
+                         '(resource_id TEXT PRIMARY KEY)')
+            conn.execute('DELETE FROM keep')
+            conn.executemany('INSERT OR IGNORE INTO keep VALUES (?)',
+                             ((r,) for r in resource_ids if r))
+            conn.execute('DELETE FROM resources WHERE resource_id NOT IN '
+                         '(SELECT resource_id FROM keep)')
+            conn.execute('DELETE FROM keep')
+
+    def next_sequence(self, name, count=1):
+        """Reserve ``count`` numbers from sequence ``name``, return the first."""
+        conn = self._connect()
+        with conn:
+            # Take the write lock up front so concurrent callers serialise.
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT value FROM sequences WHERE name = ?',
+                               (name,)).fetchone()
+            first = (row[0] if row else 0) + 1
+            conn.execute('INSERT OR REPLACE INTO sequences (name, value) '
+                         'VALUES (?, ?)', (name, first + count - 1))
+        return first
+
+    def filenames(self):
+        """Return the names of all files currently owned by a resource."""
+        return {row[0] for row in self._connect().execute(
+            'SELECT DISTINCT filename FROM resources')}
+
+    def catalog_entry(self, dataset_id):
+        row = self._connect().execute(
+            'SELECT entry FROM catalog WHERE dataset_id = ?',
+            (dataset_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_catalog_entry(self, dataset_id, title, entry):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO catalog (dataset_id, title, entry) '
+                'VALUES (?, ?, ?)', (dataset_id, title, entry))
+
+    def drop_catalog_entry(self, dataset_id):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM catalog WHERE dataset_id = ?',
+                         (dataset_id,))
+
+    def catalog_entries(self):
+        """Return every catalog entry, ordered by dataset title."""
+        return [row[0] for row in self._connect().execute(
+            'SELECT entry FROM catalog ORDER BY title, dataset_id')]
+
+    def retain_catalog_entries(self, dataset_ids):
+        """Drop the catalog entries of datasets not in ``dataset_ids``."""
+        conn = self._connect()
+        with conn:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS keep_datasets '
+                         '(dataset_id TEXT PRIMARY KEY)')
+            conn.execute('DELETE FROM keep_datasets')
+            conn.executemany('INSERT OR IGNORE INTO keep_datasets VALUES (?)',
+                             ((d,) for d in dataset_ids if d))
+            conn.execute('DELETE FROM catalog WHERE dataset_id NOT IN '
+                         '(SELECT dataset_id FROM keep_datasets)')
+            conn.execute('DELETE FROM keep_datasets')
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(directory):
+    with _indexes_lock:
+        if directory not in _indexes:
+            _indexes[directory] = ExportIndex(directory)
+        return _indexes[directory]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Append-only NDJSON feed of changes to the JSON export."""
+
+import datetime
+import fcntl
+import json
+import os
+
+JOURNAL_DIRNAME = '.journal'
+ACTIVE_FILENAME = 'changes.ndjson'
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_KEEP = 10
+
+
+class Journal(object):
+    """One line per exported or deleted file, numbered by ``seq``.
+
+    Lines are appended to ``changes.ndjson``. Once that grows past
+    ``max_bytes`` it is renamed to ``changes-<last seq>.ndjson`` and a new
+    file is started, keeping the ``keep`` most recent rotated files.
+    Consumers remember the last ``seq`` they processed and skip anything up
+    to it. Sequence numbers come from the export index, and appends are
+    serialised with a lock file, so several processes can share a journal.
+    """
+
+    def __init__(self, directory, export_index, max_bytes=DEFAULT_MAX_BYTES,
+                 keep=DEFAULT_KEEP):
+        self.directory = directory
+        self.path = os.path.join(directory, ACTIVE_FILENAME)
+        self._lock_path = os.path.join(directory, '.lock')
+        self._index = export_index
+        self.max_bytes = max_bytes
+        self.keep = keep
+
+    def append(self, events):
+        """Record ``events``, dicts with ``event``, ``file`` and ``hash`` etc."""
+        if not events:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        ts = datetime.datetime.utcnow().isoformat()
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            first = self._index.next_sequence('journal', len(events))
+            lines = ''.join(
+                json.dumps(dict(event, seq=first + i, ts=ts),
+                           separators=(',', ':'), ensure_ascii=False) + '\n'
+                for i, event in enumerate(events))
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(lines)
+            if os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate(first + len(events) - 1)
+
+    def _rotate(self, last_seq):
+        os.replace(self.path, os.path.join(
+            self.directory, f'changes-{last_seq:012d}.ndjson'))
+        rotated = sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith('changes-') and name.endswith('.ndjson'))
+        for name in rotated[:-self.keep] if self.keep else rotated:
+            os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Process-local counters, gauges and timing histograms.
+
+Everything recorded here can be scraped in the Prometheus text format (see
+``render_prometheus`` and the ``/extrafields/metrics`` view) and, when
+``ckanext.extrafields.statsd_host`` is set, is also sent to StatsD as it
+happens. The Prometheus figures only cover the process that serves the
+scrape, so with several workers StatsD gives the complete picture.
+"""
+
+import contextlib
+import logging
+import re
+import socket
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the timing histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+PROMETHEUS_PREFIX = 'ckanext_extrafields_'
+
+DEFAULT_STATSD_PORT = 8125
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_statsd = None
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+    if _statsd is not None:
+        _statsd.send(f'{name}:{value}|c')
+
+
+def set_gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+    if _statsd is not None:
+        _statsd.send(f'{name}:{value}|g')
+
+
+def max_gauge(name, value):
+    """Raise gauge ``name`` to ``value`` if it is currently lower."""
+    with _lock:
+        if value <= _gauges.get(name, 0):
+            return
+        _gauges[name] = value
+    if _statsd is not None:
+        _statsd.send(f'{name}:{value}|g')
+
+
+def observe(name, seconds):
+    """Record a duration in histogram ``name``."""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = {
+                'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+    if _statsd is not None:
+        _statsd.send(f'{name}:{seconds * 1000:.3f}|ms')
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Time the ``with`` block into histogram ``name``."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started)
+
+
+def snapshot():
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'gauges': dict(_gauges),
+            'histograms': {name: {'count': h['count'], 'sum': h['sum']}
+                           for name, h in _histograms.items()},
+        }
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+def _prometheus_name(name):
+    return PROMETHEUS_PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def render_prometheus():
+    """Return every metric in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted(
+            (name, dict(h, buckets=list(h['buckets'])))
+            for name, h in _histograms.items())
+
+    lines = []
+    for name, value in counters:
+        metric = _prometheus_name(name) + '_total'
+        lines.append(f'# TYPE {metric} counter')
+        lines.append(f'{metric} {value}')
+    for name, value in gauges:
+        metric = _prometheus_name(name)
+        lines.append(f'# TYPE {metric} gauge')
+        lines.append(f'{metric} {value}')
+    for name, histogram in histograms:
+        metric = _prometheus_name(name) + '_seconds'
+        lines.append(f'# TYPE {metric} histogram')
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram['buckets']):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram["count"]}')
+        lines.append(f'{metric}_sum {histogram["sum"]}')
+        lines.append(f'{metric}_count {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class StatsdClient(object):
+    """Fire-and-forget StatsD sender over UDP."""
+
+    def __init__(self, host, port, prefix='ckanext.extrafields'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, stat):
+        try:
+            self._sock.sendto(f'{self.prefix}.{stat}'.encode('utf-8'),
+                              self.address)
+        except OSError:
+            # Metrics must never break a request.
+            pass
+
+
+def configure(config):
+    """Set up the StatsD emitter from the CKAN config."""
+    global _statsd
+    host = config.get('ckanext.extrafields.statsd_host')
+    if not host:
+        _statsd = None
+        return
+    host, _, port = host.partition(':')
+    try:
+        port = int(port or DEFAULT_STATSD_PORT)
+    except ValueError:
+        log.warning(f"Invalid port in ckanext.extrafields.statsd_host "
+                    f"{port!r}, using {DEFAULT_STATSD_PORT}")
+        port = DEFAULT_STATSD_PORT
+    _statsd = StatsdClient(
+        host, port,
+        config.get('ckanext.extrafields.statsd_prefix',
+                   'ckanext.extrafields'))
+    log.info(f"Sending extrafields metrics to StatsD at {host}:{port}")
@@ -1,128 +1,182 @@
 import ckan.plugins as p
 import ckan.plugins.toolkit as tk
+import hashlib
 import json
-import os
-import re
+import logging
+import threading
+import time
+import ckan.model as model
 from ckan.logic import chained_action
 from ckan.logic.action.create import package_create as core_package_create
 from ckan.logic.action.update import package_update as core_package_update
 from ckan.logic.action.delete import resource_delete as core_resource_delete
 
-# ================================
-# JSON FILE HANDLING LOGIC (NEW)
-# ================================
+from ckanext.extrafields import (
+    bulk, cli, export, metrics, search, spatial, views)
 
-SHARED_DIR = '/shared/allJsons'
-
-def sanitize_filename(text):
-    """Convert any string into safe filename (alphanumeric + underscore/dash)."""
-    if not isinstance(text, str):
-        text = str(text)
-    safe = re.sub(r'[^a-zA-Z0-9\-_\.]', '_', text.strip())
-    safe = re.sub(r'_+', '_', safe)
-    safe = safe.strip('_')
-    return safe if safe else 'untitled'
-
-def get_resource_filename(dataset_title, resource):
-    """Generate filename: {DatasetTitle}__{resource_year_code}.json"""
-    year_code = resource.get('resource_year_code', 'unknown')  # ← YOUR FIELD NAME
-    title_part = sanitize_filename(dataset_title)
-    year_part = sanitize_filename(year_code)
-    return f"{title_part}__{year_part}.json"
-
-def write_resource_json(dataset_dict, resource, action):
-    """Write one JSON file per resource."""
-    os.makedirs(SHARED_DIR, exist_ok=True)
-
-    dataset_title = dataset_dict.get('title', 'Untitled Dataset')
-    filename = get_resource_filename(dataset_title, resource)
-    filepath = os.path.join(SHARED_DIR, filename)
-
-    data_to_write = {
-        'dataset': {
-            'id': dataset_dict.get('id'),
-            'name': dataset_dict.get('name'),
-            'title': dataset_title,
-        },
-        'resource': resource,
-        'action': action,
-        'timestamp': tk.datetime.datetime.utcnow().isoformat()
-    }
+log = logging.getLogger(__name__)
 
-    try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(data_to_write, f, indent=2, ensure_ascii=False)
-        tk.log.info(f"✅ Resource JSON written: {filepath}")
-    except Exception as e:
-        tk.log.error(f"❌ Failed to write {filepath}: {e}")
+# Each chained action times the core action and the extension's own work
+# separately, as action.<name>.core and action.<name>.extension.
 
-def delete_resource_json(dataset_title, resource):
-    """Delete corresponding JSON file for this resource."""
-    filename = get_resource_filename(dataset_title, resource)
-    filepath = os.path.join(SHARED_DIR, filename)
+# Simplification tolerance for spatial_simplified, in degrees (about 100m).
+DEFAULT_SPATIAL_TOLERANCE = 0.001
 
+def spatial_tolerance():
+    return float(tk.config.get('ckanext.extrafields.spatial_tolerance',
+                               DEFAULT_SPATIAL_TOLERANCE))
+
+def derive_spatial(data_dict, stored=None):
+    """ Validate `spatial` and store the fields derived from it.
+
+    Values that look like JSON must be a GeoJSON geometry, Feature or
+    FeatureCollection; anything else is kept as a plain description and
+    gets no derived fields. An invalid value equal to `stored`, the one
+    already saved, is kept as it is, so that saving a dataset for any other
+    reason (e.g. from resource_delete) doesn't fail on it.
+    """
+    for field in spatial.DERIVED_FIELDS:
+        data_dict.pop(field, None)
+    value = data_dict.get('spatial')
+    if not isinstance(value, str) or not value.lstrip().startswith('{'):
+        return data_dict
     try:
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            tk.log.info(f"🗑️ Deleted resource JSON: {filepath}")
-        else:
-            tk.log.warning(f"⚠️ JSON file not found for deletion: {filepath}")
-    except Exception as e:
-        tk.log.error(f"❌ Failed to delete {filepath}: {e}")
+        geometry = spatial.parse_geometry(value)
+        derived = spatial.derived_fields(geometry, spatial_tolerance())
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        derived = None
+    if derived is None:
+        if value == stored:
+            return data_dict
+        raise tk.ValidationError(
+            {'spatial': [tk._('Not a valid GeoJSON geometry')]})
+    data_dict.update(derived)
+    return data_dict
+
+def _stored_spatial(data_dict):
+    """ The `spatial` value saved for the dataset being updated, if any. """
+    reference = data_dict.get('id') or data_dict.get('name')
+    package = model.Package.get(reference) if reference else None
+    return package.extras.get('spatial') if package is not None else None
 
 @chained_action  # 👈 NOT tk.chained_action
 def package_create(original_action, context, data_dict):
-    print("🚀🚀🚀 package_create ACTION TRIGGERED!")  # This prints to container stdout
-    tk.log.info("🚀 package_create ACTION TRIGGERED!")
-
-    result = original_action(context, data_dict)
-    for resource in result.get('resources', []):
-        write_resource_json(result, resource, 'create')
+    log.debug("package_create action triggered")
+    with metrics.timer('action.package_create.spatial'):
+        data_dict = derive_spatial(dict(data_dict))
+    with metrics.timer('action.package_create.core'):
+        result = original_action(context, data_dict)
+    if context.get(bulk.DEFER_EXPORT):
+        # extrafields_bulk_upsert exports once its chunk is committed.
+        return result
+    with metrics.timer('action.package_create.extension'):
+        export.export_dataset(result, 'create')
+        search.invalidate_facet_counts()
     return result
 
 @chained_action  # 👈 NOT tk.chained_action
 def package_update(original_action, context, data_dict):
-     print("🚀🚀🚀 package_update ACTION TRIGGERED!")  # This prints to container stdout
-    tk.log.info("🚀 package_update ACTION TRIGGERED!")
-    result = original_action(context, data_dict)
-    for resource in result.get('resources', []):
-        write_resource_json(result, resource, 'update')
+    log.debug("package_update action triggered")
+    with metrics.timer('action.package_update.spatial'):
+        data_dict = derive_spatial(dict(data_dict),
+                                   _stored_spatial(data_dict))
+    with metrics.timer('action.package_update.core'):
+        result = original_action(context, data_dict)
+    if context.get(bulk.DEFER_EXPORT):
+        # extrafields_bulk_upsert exports once its chunk is committed.
+        return result
+    with metrics.timer('action.package_update.extension'):
+        export.export_dataset(result, 'update')
+        search.invalidate_facet_counts()
     return result
 
+def _modified_after_delete(dataset_id):
+    """ The dataset's `metadata_modified` once the core delete has run. """
+    try:
+        dataset = model.Package.get(dataset_id)
+    except Exception as e:
+        log.error(f"Error reading the dataset after delete: {e}")
+        return None
+    if dataset is None or dataset.metadata_modified is None:
+        return None
+    return dataset.metadata_modified.isoformat()
+
+def _export_stub(resource_id, extras):
+    """ The parts of a resource the exporter needs to find its file. """
+    stub = {'id': resource_id}
+    if extras and 'resource_year_code' in extras:
+        stub['resource_year_code'] = extras['resource_year_code']
+    return stub
+
 @chained_action  # 👈 NOT tk.chained_action
 def resource_delete(original_action, context, data_dict):
-    """Intercept resource delete to remove its JSON file first."""
+    """Intercept resource delete to remove its JSON file as well."""
 
-     print("🚀🚀🚀 resource_delete ACTION TRIGGERED!")  # This prints to container stdout
-    tk.log.info("🚀 resource_delete ACTION TRIGGERED!")
+    log.debug("resource_delete action triggered")
     resource_id = data_dict.get('id')
     if not resource_id:
         return original_action(context, data_dict)
 
+    # Only read the columns the file name is built from, rather than running
+    # resource_show and package_show before the core action does it again.
+    row = None
+    started = time.perf_counter()
     try:
-        # Fetch resource and its parent dataset BEFORE deletion
-        resource = tk.get_action('resource_show')(context, {'id': resource_id})
-        dataset = tk.get_action('package_show')(context, {'id': resource['package_id']})
-        dataset_title = dataset.get('title', 'Untitled Dataset')
-
-        # Delete associated JSON file
-        delete_resource_json(dataset_title, resource)
-
+        row = (model.Session.query(model.Resource.extras,
+                                   model.Package.id, model.Package.title)
+               .join(model.Package,
+                     model.Package.id == model.Resource.package_id)
+               .filter(model.Resource.id == resource_id)
+               .first())
     except Exception as e:
-        tk.log.error(f"⚠️ Error during pre-delete JSON cleanup: {e}")
-
-    # Proceed with actual deletion
-    return original_action(context, data_dict)
+        log.error(f"⚠️ Error during pre-delete JSON cleanup: {e}")
+    lookup = time.perf_counter() - started
+
+    # Proceed with actual deletion, and only drop the file if it succeeded
+    with metrics.timer('action.resource_delete.core'):
+        result = original_action(context, data_dict)
+    started = time.perf_counter()
+    if row is not None:
+        extras, dataset_id, dataset_title = row
+        export.remove_dataset_exports(
+            dataset_id, dataset_title, [_export_stub(resource_id, extras)],
+            modified=_modified_after_delete(dataset_id))
+    search.invalidate_facet_counts()
+    metrics.observe('action.resource_delete.extension',
+                    lookup + time.perf_counter() - started)
+    return result
 
 @chained_action
 def package_delete(original_action, context, data_dict):
+    # As in resource_delete, read just the title and the resources' extras
+    # instead of running the full package_show.
+    log.debug("package_delete action triggered")
+    found = None
+    started = time.perf_counter()
     try:
-        dataset = tk.get_action('package_show')(context, data_dict)
-        for resource in dataset.get('resources', []):
-            delete_resource_json(dataset.get('title', 'Untitled Dataset'), resource)
+        dataset = model.Package.get(data_dict.get('id'))
+        if dataset is not None:
+            resources = [
+                _export_stub(resource_id, extras)
+                for resource_id, extras in model.Session.query(
+                    model.Resource.id, model.Resource.extras)
+                .filter(model.Resource.package_id == dataset.id)
+                .filter(model.Resource.state == 'active')]
+            found = (dataset.id, dataset.title, resources)
     except Exception as e:
-        tk.log.error(f"Error cleaning up JSONs on dataset delete: {e}")
-    return original_action(context, data_dict)
+        log.error(f"Error cleaning up JSONs on dataset delete: {e}")
+    lookup = time.perf_counter() - started
+
+    with metrics.timer('action.package_delete.core'):
+        result = original_action(context, data_dict)
+    started = time.perf_counter()
+    if found is not None:
+        export.remove_dataset_exports(
+            *found, manifest=True, modified=_modified_after_delete(found[0]))
+    search.invalidate_facet_counts()
+    metrics.observe('action.package_delete.extension',
+                    lookup + time.perf_counter() - started)
+    return result
 
 # ================================
 # EXISTING VOCABULARY & HELPER CODE
@@ -130,134 +184,278 @@ def package_delete(original_action, context, data_dict):
 
 
 
-# Jiten, Testing new_topics_codes
-def create_new_topics_codes():
-    user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name']}
+# Tag vocabularies used by the dataset form, and the tags each one is seeded
+# with.  Add tags here and restart (or run `ckan extrafields init-vocabs`) to
+# roll them out; tags already in the database are never removed.
+VOCABULARIES = {
+    'new_topics_codes': (
+        u'Art Culture', u'Basic needs', u'Children and Families',
+        u'Civics and Public Safety', u'Economy', u'Education',
+        u'Equity and Equality', u'Health', u'Housing', u'People',
+        u'Transportation'),
+    'all_granulatiry_codes': (
+        u'Elementary School', u'High School', u'Middle School',
+        u'Combination School', u'Blocks', u'Block Groups', u'Tracts',
+        u'Places', u'ZCTA', u'Florida Counties',
+        u'Florida Congressional Districts', u'Florida House Districts',
+        u'Florida Senate Districts'),
+    'geography_codes': (
+        u'All Florida', u'DeSoto', u'Hillsborough', u'Manatee', u'Pinellas',
+        u'Sarasota'),
+    'frequency_codes': (
+        u'None', u'Hourly', u'Daily', u'Weekly', u'Monthly', u'Quarterly',
+        u'Annually', u'Decennially', u'Continuously', u'Irregularly'),
+    'census_geo_year_codes': (u'2000', u'2010', u'2020', u'2030'),
+    'resource_year_codes': tuple(str(year) for year in range(2020, 2030)),
+}
+
+
+def seed_vocabulary(name, tags):
+    """Add ``name`` and any of ``tags`` it is missing to the session.
+
+    Works on the model directly so a whole vocabulary is one INSERT batch
+    instead of a ``tag_create`` call (auth check, commit) per tag. The caller
+    commits. Returns the number of tags added.
+    """
+    vocab = model.Vocabulary.get(name)
+    if vocab is None:
+        vocab = model.Vocabulary(name)
+        model.Session.add(vocab)
+        model.Session.flush()
+        existing = set()
+    else:
+        existing = {row.name for row in model.Session.query(model.Tag.name)
+                    .filter(model.Tag.vocabulary_id == vocab.id)}
+
+    missing = [tag for tag in tags if tag not in existing]
+    model.Session.add_all(
+        model.Tag(name=tag, vocabulary_id=vocab.id) for tag in missing)
+    return len(missing)
+
+
+def seed_vocabularies():
+    """Create any of our vocabularies or tags that don't exist yet.
+
+    Safe to run repeatedly, and everything is committed in one transaction.
+    This runs once at startup (see ``configure``) and from ``ckan
+    extrafields init-vocabs``, so the template helpers never have to.
+    """
     try:
-        data = {'id': 'new_topics_codes'}
-        tk.get_action('vocabulary_show')(context, data)
-    except tk.ObjectNotFound:
-        data = {'name': 'new_topics_codes'}
-        vocab = tk.get_action('vocabulary_create')(context, data)
-        """ topic = {"1":"Art Culture", "2":"Basic needs", "3":"Children AND Families", "4":"Civic AND Public Safety", "5":"Economy"} """
-        for tag in (u'Art Culture', u'Basic needs', u'Children and Families', u'Civics and Public Safety', u'Economy', u'Education', u'Equity and Equality', u'Health', u'Housing', u'People', u'Transportation'):
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            tk.get_action('tag_create')(context, data)    
+        added = sum(seed_vocabulary(name, tags)
+                    for name, tags in VOCABULARIES.items())
+        model.repo.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+    invalidate_vocabulary_cache()
+    return added
 
 
+# ================================
+# VOCABULARY CACHE
+# ================================
 
-def create_all_granulatiry_codes():
-    user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name']}
-    try:
-        data = {'id': 'all_granulatiry_codes'}
-        tk.get_action('vocabulary_show')(context, data)
+# Tag lists change very rarely, so the template helpers read them through a
+# process-local cache.  Entries expire after ``ckanext.extrafields.
+# vocab_cache_ttl`` seconds (0 disables the cache) and are dropped straight
+# away when tags or vocabularies are changed through the action API.
+DEFAULT_VOCAB_CACHE_TTL = 300
 
-        # data = {'name': 'all_granulatiry_codes'}
-        # vocab = tk.get_action('vocabulary_update')(context, data)
-        # for tag in (u'Elementary School',u'High School',u'Middle School',u'Combination School',u'Blocks',u'Block Groups', u'Tracts', u'Places', u'ZCTA', u'Florida Counties',u'Florida Congressional Districts',u'Florida House Districts',u'Florida Senate Districts'):
-        #     data = {'name': tag, 'vocabulary_id': vocab['id']}
-        #     tk.get_action('tag_create')(context, data)
+_vocab_cache = {}
+_vocab_cache_lock = threading.Lock()
 
 
-    except tk.ObjectNotFound:
-        data = {'name': 'all_granulatiry_codes'}
-        vocab = tk.get_action('vocabulary_create')(context, data)
-        for tag in (u'Elementary School',u'High School',u'Middle School',u'Combination School',u'Blocks',u'Block Groups', u'Tracts', u'Places', u'ZCTA', u'Florida Counties',u'Florida Congressional Districts',u'Florida House Districts',u'Florida Senate Districts'):
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            tk.get_action('tag_create')(context, data)
+def vocab_cache_ttl():
+    return tk.asint(tk.config.get('ckanext.extrafields.vocab_cache_ttl',
+                                  DEFAULT_VOCAB_CACHE_TTL))
 
 
+def invalidate_vocabulary_cache(vocabulary=None):
+    """Drop the cached tags of ``vocabulary``, or of every vocabulary.
 
-def create_geography_codes():
-    user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name']}
-    try:
-        data = {'id': 'geography_codes'}
-        tk.get_action('vocabulary_show')(context, data)
-    except tk.ObjectNotFound:
-        data = {'name': 'geography_codes'}
-        vocab = tk.get_action('vocabulary_create')(context, data)
-        for tag in (u'All Florida', u'DeSoto', u'Hillsborough', u'Manatee', u'Pinellas', u'Sarasota'):
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            tk.get_action('tag_create')(context, data)
+    ``vocabulary`` may be a vocabulary name or id.  Entries are keyed by name,
+    so an id (or anything we don't recognise) clears the whole cache.
+    """
+    with _vocab_cache_lock:
+        if vocabulary in VOCABULARIES:
+            _vocab_cache.pop(vocabulary, None)
+        else:
+            _vocab_cache.clear()
 
 
-def create_frequency_codes():
-    user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name']}
-    try:
-        data = {'id': 'frequency_codes'}
-        tk.get_action('vocabulary_show')(context, data)
-    except tk.ObjectNotFound:
-        data = {'name': 'frequency_codes'}
-        vocab = tk.get_action('vocabulary_create')(context, data)
-        for tag in (u'None', u'Hourly', u'Daily', u'Weekly', u'Monthly', u'Quarterly', u'Annually', u'Decennially', u'Continuously', u'Irregularly'):
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            tk.get_action('tag_create')(context, data)
-
-def create_census_geo_year_codes():
-    user = tk.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name']}
+def _load_vocabulary_tags(vocabulary):
     try:
-        data = {'id': 'census_geo_year_codes'}
-        tk.get_action('vocabulary_show')(context, data)
+        return tk.get_action('tag_list')(
+                data_dict={'vocabulary_id': vocabulary})
     except tk.ObjectNotFound:
-        data = {'name': 'census_geo_year_codes'}
-        vocab = tk.get_action('vocabulary_create')(context, data)
-        for tag in (u'2000', u'2010', u'2020', u'2030'):
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            tk.get_action('tag_create')(context, data)
+        return None
+
+
+def get_vocabulary_tags(vocabulary):
+    """ Return the tag names of ``vocabulary``, using the vocabulary cache. """
+    ttl = vocab_cache_ttl()
+    if ttl > 0:
+        with _vocab_cache_lock:
+            cached = _vocab_cache.get(vocabulary)
+        if cached is not None and time.monotonic() - cached[0] < ttl:
+            metrics.incr('vocab.cache.hits')
+            return list(cached[1])
+
+    metrics.incr('vocab.cache.misses')
+    with metrics.timer('vocab.load'):
+        tags = _load_vocabulary_tags(vocabulary)
+    if tags is None:
+        return None
+    if ttl > 0:
+        with _vocab_cache_lock:
+            _vocab_cache[vocabulary] = (time.monotonic(), tuple(tags))
+    return list(tags)
 
 
 def geography_codes():
     """ Return the list of County from the County Vocabulary. """
-    create_geography_codes()
-    #add_county_tag_in_vocab()
-    try:
-        geography_codes = tk.get_action('tag_list')(
-                data_dict={'vocabulary_id':'geography_codes'})
-        return geography_codes
-    except tk.ObjectNotFound:
-        return None
+    return get_vocabulary_tags('geography_codes')
 
 def new_topics_codes():
-    create_new_topics_codes()
-    try:
-        new_topics_codes = tk.get_action('tag_list')(
-                data_dict={'vocabulary_id':'new_topics_codes'})
-        return new_topics_codes
-    except tk.ObjectNotFound:
-        return None
+    return get_vocabulary_tags('new_topics_codes')
 
 def all_granulatiry_codes():
-    create_all_granulatiry_codes()
-    try:
-        all_granulatiry_codes = tk.get_action('tag_list')(
-                data_dict={'vocabulary_id':'all_granulatiry_codes'})
-        return all_granulatiry_codes
-    except tk.ObjectNotFound:
-        return None
+    return get_vocabulary_tags('all_granulatiry_codes')
 
 def frequency_codes():
-    create_frequency_codes()
-    try:
-        frequency_codes = tk.get_action('tag_list')(
-                data_dict={'vocabulary_id':'frequency_codes'})
-        return frequency_codes
-    except tk.ObjectNotFound:
-        return None
+    return get_vocabulary_tags('frequency_codes')
 
 def census_geo_year_codes():
-    create_census_geo_year_codes()
-    try:
-        census_geo_year_codes = tk.get_action('tag_list')(
-                data_dict={'vocabulary_id':'census_geo_year_codes'})
-        return census_geo_year_codes
-    except tk.ObjectNotFound:
-        return None
+    return get_vocabulary_tags('census_geo_year_codes')
+
+def resource_year_codes():
+    return get_vocabulary_tags('resource_year_codes')
+
+def vocabulary_facet_counts():
+    """ Return {vocabulary: {code: number of datasets}} for the tag fields. """
+    return search.vocabulary_facet_counts(TAG_FIELDS.values())
+
+def _tags_or_seed(vocabulary):
+    # Vocabularies that haven't been created yet fall back to the tags they
+    # would be seeded with.
+    tags = get_vocabulary_tags(vocabulary)
+    return tags if tags is not None else list(VOCABULARIES[vocabulary])
+
+def vocabularies():
+    """ Return {vocabulary: [tags]} for every vocabulary of the extension. """
+    return {name: _tags_or_seed(name) for name in VOCABULARIES}
+
+def vocabulary_options(vocabulary):
+    """ Return the tags of ``vocabulary`` as options for form.select. """
+    return [{'value': tag, 'text': tag} for tag in _tags_or_seed(vocabulary)]
+
+
+@tk.side_effect_free
+def extrafields_vocabularies(context, data_dict):
+    """ Return every extension vocabulary in one payload.
+
+    :returns: ``vocabularies``, {name: [sorted tags]}, and ``hash``, a
+        digest of the vocabularies that changes whenever any of their tags
+        does
+    :rtype: dictionary
+    """
+    tk.check_access('extrafields_vocabularies', context, data_dict)
+    # Tags come back in database order, which isn't stable; sort them so
+    # the same tags always give the same hash (and ETag).
+    result = {name: sorted(tags) for name, tags in vocabularies().items()}
+    digest = hashlib.sha256(json.dumps(
+        result, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    return {'vocabularies': result, 'hash': digest.hexdigest()}
+
+
+@tk.auth_allow_anonymous_access
+def extrafields_vocabularies_auth(context, data_dict):
+    return {'success': True}
+
+
+@chained_action
+def tag_create(original_action, context, data_dict):
+    result = original_action(context, data_dict)
+    if result.get('vocabulary_id'):
+        invalidate_vocabulary_cache(data_dict.get('vocabulary_id'))
+    return result
+
+@chained_action
+def tag_delete(original_action, context, data_dict):
+    result = original_action(context, data_dict)
+    if data_dict.get('vocabulary_id'):
+        invalidate_vocabulary_cache(data_dict['vocabulary_id'])
+    return result
+
+@chained_action
+def vocabulary_update(original_action, context, data_dict):
+    result = original_action(context, data_dict)
+    # The vocabulary may have been renamed, so don't trust either name.
+    invalidate_vocabulary_cache()
+    return result
+
+
+
+# ================================
+# DATASET SCHEMA
+# ================================
 
+# Dataset fields stored as vocabulary tags, and their vocabulary.
+TAG_FIELDS = {
+    # 'topics_code': 'new_topics_codes',
+    'geography_code': 'geography_codes',
+    'granulatiry_code': 'all_granulatiry_codes',
+    'frequency_code': 'frequency_codes',
+    # 'census_geo_year_code': 'census_geo_year_codes',
+}
+
+# Search facets for the tag vocabularies, labelled as in the dataset form.
+FACET_LABELS = {
+    'geography_codes': 'Geography',
+    'all_granulatiry_codes': 'Granulatiry',
+    'frequency_codes': 'Update Frequency',
+}
+
+# Dataset fields stored as extras.
+EXTRA_FIELDS = (
+    'custom_text',
+    'spatial',
+    'spatial_text',
+    # Derived from spatial on every save, see derive_spatial.
+    'spatial_bbox',
+    'spatial_centroid',
+    'spatial_simplified',
+    'temporal_start',
+    'temporal_end',
+    'publisher_name',
+    'publisher_URL',
+    'data_dictionary_URL',
+    'issued',
+    'modified',
+)
+
+# Extra fields on resources.
+RESOURCE_FIELDS = (
+    'terria_catalogue',
+    'point_or_polygon',
+    'census_geo_year_code',
+    'resource_year_code',
+    'release_date',
+)
+
+_schema_cache = {}
+
+
+def _copy_schema(schema):
+    """Copy the dicts and lists of a schema, sharing the validators.
+
+    Much cheaper than deepcopy, which would also walk every validator.
+    """
+    if isinstance(schema, dict):
+        return {key: _copy_schema(value) for key, value in schema.items()}
+    if isinstance(schema, list):
+        return [_copy_schema(value) for value in schema]
+    return schema
 
 
 class ExampleIDatasetFormPlugin(p.SingletonPlugin, tk.DefaultDatasetForm):
@@ -265,16 +463,77 @@ class ExampleIDatasetFormPlugin(p.SingletonPlugin, tk.DefaultDatasetForm):
     p.implements(p.IConfigurer, inherit=False)
     p.implements(p.ITemplateHelpers, inherit=False)
     p.implements(p.ITemplateHelpers, inherit=False)
+    p.implements(p.IActions)
+    p.implements(p.IConfigurable)
+    p.implements(p.IClick)
+    p.implements(p.IBlueprint)
+    p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IFacets, inherit=True)
+    p.implements(p.IAuthFunctions)
 
     def update_config(self, config):
         # Add this plugin's templates dir to CKAN's extra_template_paths, so
         # that CKAN will use this plugin's custom templates.
         tk.add_template_directory(config, 'templates')
+        # Other plugins' validators may have changed, rebuild our schemas.
+        _schema_cache.clear()
+
+    def configure(self, config):
+        level = config.get('ckanext.extrafields.log_level')
+        if level:
+            try:
+                logging.getLogger('ckanext.extrafields').setLevel(
+                    level.upper())
+            except ValueError:
+                log.warning(f"Unknown ckanext.extrafields.log_level value "
+                            f"{level!r}, using the CKAN logging config")
+        metrics.configure(config)
+
+        # Seed the vocabularies once per process instead of on every helper
+        # call. The database may not be initialised yet (e.g. while running
+        # `ckan db init`), in which case `ckan extrafields init-vocabs` has
+        # to be run once it is.
+        if not tk.asbool(config.get(
+                'ckanext.extrafields.seed_vocabularies_on_startup', True)):
+            return
+        try:
+            seed_vocabularies()
+        except Exception as e:
+            log.warning(f"Could not seed extrafields vocabularies: {e}")
+
+    def get_commands(self):
+        return cli.get_commands()
+
+    def get_blueprint(self):
+        return views.get_blueprints()
     
+    # IPackageController (before_index/before_search up to CKAN 2.9, the
+    # dataset_ variants from 2.10 on)
+
+    def before_index(self, pkg_dict):
+        return search.before_index(pkg_dict)
+
+    def before_dataset_index(self, pkg_dict):
+        return search.before_index(pkg_dict)
+
+    def before_search(self, search_params):
+        return search.before_search(search_params)
+
+    def before_dataset_search(self, search_params):
+        return search.before_search(search_params)
+
+    def dataset_facets(self, facets_dict, package_type):
+        for vocabulary, label in FACET_LABELS.items():
+            facets_dict['vocab_' + vocabulary] = tk._(label)
+        return facets_dict
+
     def get_helpers(self):
         """ return {'country_codes': country_codes} """
         #return {'topics_codes': topics_codes, 'county_codes': county_codes}
-        return {'new_topics_codes': new_topics_codes, 'geography_codes': geography_codes, 'all_granulatiry_codes': all_granulatiry_codes, 'frequency_codes':frequency_codes, 'census_geo_year_codes':census_geo_year_codes}
+        return {'new_topics_codes': new_topics_codes, 'geography_codes': geography_codes, 'all_granulatiry_codes': all_granulatiry_codes, 'frequency_codes':frequency_codes, 'census_geo_year_codes':census_geo_year_codes,
+                'resource_year_codes': resource_year_codes,
+                'vocabulary_facet_counts': vocabulary_facet_counts,
+                'vocabulary_options': vocabulary_options}
     
     def is_fallback(self):
         # Return True to register this plugin as the default handler for
@@ -285,158 +544,90 @@ class ExampleIDatasetFormPlugin(p.SingletonPlugin, tk.DefaultDatasetForm):
         # This plugin doesn't handle any special package types, it just
         # registers itself as the default (above).
         return []
+
+    def validate(self, context, data_dict, schema, action):
+        # The core actions roll back the whole session when validation
+        # fails, which would take the rest of a bulk upsert's chunk with
+        # it; raise first, so only the dataset's own savepoint is undone.
+        if not context.get(bulk.RAISE_INVALID) or action not in (
+                'package_create', 'package_update'):
+            return None
+        data, errors = tk.navl_validate(data_dict, schema, context)
+        if errors:
+            raise tk.ValidationError(errors)
+        return data, errors
     
     def _modify_package_schema(self, schema):
-        # Add our custom country_code metadata field to the schema.  
-        schema.update({
-            # 'topics_code': [tk.get_validator('ignore_missing'),
-            #         tk.get_converter('convert_to_tags')('topics_codes')],
-            # 'topics_code': [tk.get_validator('ignore_missing'),
-            #         tk.get_converter('convert_to_tags')('new_topics_codes')],
-            
-            'geography_code': [tk.get_validator('ignore_missing'),
-                    tk.get_converter('convert_to_tags')('geography_codes')],
-
-            'granulatiry_code': [tk.get_validator('ignore_missing'),
-                    tk.get_converter('convert_to_tags')('all_granulatiry_codes')],
-
-            'frequency_code': [tk.get_validator('ignore_missing'),
-                    tk.get_converter('convert_to_tags')('frequency_codes')],
-
-            # 'census_geo_year_code': [tk.get_validator('ignore_missing'),
-            #         tk.get_converter('convert_to_tags')('census_geo_year_codes')],
-
-            'custom_text': [tk.get_validator('ignore_missing'),
-                    tk.get_converter('convert_to_extras')],
-            'spatial': [tk.get_validator('ignore_missing'),
-                            tk.get_converter('convert_to_extras')],
-            'spatial_text': [tk.get_validator('ignore_missing'),
-                            tk.get_converter('convert_to_extras')],
-            'temporal_start': [tk.get_validator('ignore_missing'),
-                            tk.get_converter('convert_to_extras')],
-            'temporal_end': [tk.get_validator('ignore_missing'),
-                            tk.get_converter('convert_to_extras')],
-            'publisher_name': [tk.get_validator('ignore_missing'),
-                            tk.get_converter('convert_to_extras')],
-            'publisher_URL': [tk.get_validator('ignore_missing'),
-                            tk.get_converter('convert_to_extras')],
-            'data_dictionary_URL': [tk.get_validator('ignore_missing'),
-                            tk.get_converter('convert_to_extras')],                
-            'issued': [tk.get_validator('ignore_missing'),
-                            tk.get_converter('convert_to_extras')],
-            'modified': [tk.get_validator('ignore_missing'),
-                            tk.get_converter('convert_to_extras')]
-        })
+        # Add our custom metadata fields to the schema.
+        for field, vocabulary in TAG_FIELDS.items():
+            schema[field] = [tk.get_validator('ignore_missing'),
+                    tk.get_converter('convert_to_tags')(vocabulary)]
+        for field in EXTRA_FIELDS:
+            schema[field] = [tk.get_validator('ignore_missing'),
+                    tk.get_converter('convert_to_extras')]
         # Add resource  metadata field to the schema
-        schema['resources'].update({
-                'terria_catalogue' : [ tk.get_validator('ignore_missing') ]
-                })
-        schema['resources'].update({
-                'point_or_polygon' : [ tk.get_validator('ignore_missing') ]
-                })
-        schema['resources'].update({
-                'census_geo_year_code' : [ tk.get_validator('ignore_missing') ]
-                })
-        schema['resources'].update({
-                'resource_year_code' : [ tk.get_validator('ignore_missing') ]
-                })
-        schema['resources'].update({
-                'release_date' : [ tk.get_validator('ignore_missing') ]
-                })
-
+        schema['resources'].update(
+            (field, [tk.get_validator('ignore_missing')])
+            for field in RESOURCE_FIELDS)
         return schema
 
+    def _cached_schema(self, name, build):
+        # Schemas are built once per plugin load and handed out as copies,
+        # as callers are free to modify what they get.
+        schema = _schema_cache.get(name)
+        if schema is None:
+            schema = _schema_cache[name] = build()
+        return _copy_schema(schema)
+
     def create_package_schema(self):
         # let's grab the default schema in our plugin
-        schema = super(ExampleIDatasetFormPlugin, self).create_package_schema()
-        schema = self._modify_package_schema(schema)
-        return schema
+        return self._cached_schema('create', lambda: self._modify_package_schema(
+            super(ExampleIDatasetFormPlugin, self).create_package_schema()))
 
     def update_package_schema(self):
-        schema = super(ExampleIDatasetFormPlugin, self).update_package_schema()
-        schema = self._modify_package_schema(schema)
-        return schema
-    
+        return self._cached_schema('update', lambda: self._modify_package_schema(
+            super(ExampleIDatasetFormPlugin, self).update_package_schema()))
+
     def show_package_schema(self):
+        return self._cached_schema('show', self._build_show_package_schema)
+
+    def _build_show_package_schema(self):
         schema = super(ExampleIDatasetFormPlugin, self).show_package_schema()
-        
+
         # Don't show vocab tags mixed in with normal 'free' tags
         # (e.g. on dataset pages, or on the search page)
         schema['tags']['__extras'].append(tk.get_converter('free_tags_only'))
 
-        schema.update({
-            # 'topics_code': [
-            #     tk.get_converter('convert_from_tags')('topics_codes'),
-            #     tk.get_validator('ignore_missing')],
-
-            # 'topics_code': [
-            #     tk.get_converter('convert_from_tags')('new_topics_codes'),
-            #     tk.get_validator('ignore_missing')],
-
-
-            'geography_code': [
-                tk.get_converter('convert_from_tags')('geography_codes'),
-                tk.get_validator('ignore_missing')],
-
-            'granulatiry_code': [
-                tk.get_converter('convert_from_tags')('all_granulatiry_codes'),
-                tk.get_validator('ignore_missing')],
-
-            'frequency_code': [
-                tk.get_converter('convert_from_tags')('frequency_codes'),
-                tk.get_validator('ignore_missing')],
-
-            # 'census_geo_year_code': [
-            #     tk.get_converter('convert_from_tags')('census_geo_year_codes'),
-            #     tk.get_validator('ignore_missing')],
-
-
-            'custom_text': [tk.get_converter('convert_from_extras'),
-                tk.get_validator('ignore_missing')],
-
-            'spatial': [tk.get_converter('convert_from_extras'),
-                            tk.get_validator('ignore_missing')],
-            'spatial_text': [tk.get_converter('convert_from_extras'),
-                            tk.get_validator('ignore_missing')],
-            'temporal_start': [tk.get_converter('convert_from_extras'),
-                            tk.get_validator('ignore_missing')],
-            'temporal_end': [tk.get_converter('convert_from_extras'),
-                            tk.get_validator('ignore_missing')],
-            'publisher_name': [tk.get_converter('convert_from_extras'),
-                            tk.get_validator('ignore_missing')],
-            'publisher_URL': [tk.get_converter('convert_from_extras'),
-                            tk.get_validator('ignore_missing')],
-            'data_dictionary_URL': [tk.get_converter('convert_from_extras'),
-                            tk.get_validator('ignore_missing')],
-            'issued': [tk.get_converter('convert_from_extras'),
-                            tk.get_validator('ignore_missing')],
-            'modified': [tk.get_converter('convert_from_extras'),
-                            tk.get_validator('ignore_missing')]
-        })
+        for field, vocabulary in TAG_FIELDS.items():
+            schema[field] = [
+                tk.get_converter('convert_from_tags')(vocabulary),
+                tk.get_validator('ignore_missing')]
+        for field in EXTRA_FIELDS:
+            schema[field] = [tk.get_converter('convert_from_extras'),
+                tk.get_validator('ignore_missing')]
         # Add resource  metadata field to the schema
-        schema['resources'].update({
-                'terria_catalogue' : [ tk.get_validator('ignore_missing') ]
-                })
-        schema['resources'].update({
-                'point_or_polygon' : [ tk.get_validator('ignore_missing') ]
-                })
-        schema['resources'].update({
-                'census_geo_year_code' : [ tk.get_validator('ignore_missing') ]
-                })
-        schema['resources'].update({
-                'resource_year_code' : [ tk.get_validator('ignore_missing') ]
-                })
-        schema['resources'].update({
-                'release_date' : [ tk.get_validator('ignore_missing') ]
-                })
+        schema['resources'].update(
+            (field, [tk.get_validator('ignore_missing')])
+            for field in RESOURCE_FIELDS)
         return schema
 
     def get_actions(self):
-        tk.log.info("🔧 get_actions() CALLED — Registering package_create, package_update, resource_delete")
+        log.debug("Registering extrafields chained actions")
         return {
             'package_create': package_create,
             'package_update': package_update,
             'package_delete': package_delete,
             'resource_delete': resource_delete,
+            'tag_create': tag_create,
+            'tag_delete': tag_delete,
+            'vocabulary_update': vocabulary_update,
+            'extrafields_bulk_upsert': bulk.extrafields_bulk_upsert,
+            'extrafields_vocabularies': extrafields_vocabularies,
+        }
+
+    def get_auth_functions(self):
+        return {
+            'extrafields_bulk_upsert': bulk.extrafields_bulk_upsert_auth,
+            'extrafields_vocabularies': extrafields_vocabularies_auth,
         }
     
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Search index integration for the extension's dataset fields."""
+
+import datetime
+import json
+import logging
+import threading
+import time
+
+import ckan.plugins.toolkit as tk
+from dateutil import parser as date_parser
+
+from ckanext.extrafields import metrics, spatial
+
+log = logging.getLogger(__name__)
+
+# Extras indexed as Solr dates, under ``<field>_date`` (CKAN's schema types
+# every ``*_date`` field as a date).
+DATE_FIELDS = ('temporal_start', 'temporal_end', 'issued', 'modified')
+
+SOLR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# Fills in the parts missing from partial dates, so '2020' is 2020-01-01.
+_DATE_DEFAULTS = datetime.datetime(2000, 1, 1)
+
+
+def _field_value(pkg_dict, field):
+    value = pkg_dict.get(field)
+    if value in (None, ''):
+        value = pkg_dict.get('extras_' + field)
+    return value or None
+
+
+def to_solr_date(value):
+    """Return ``value`` as a Solr date string, or None if it isn't a date."""
+    try:
+        parsed = date_parser.parse(value, default=_DATE_DEFAULTS)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc)
+    return parsed.strftime(SOLR_DATE_FORMAT)
+
+
+def spatial_field():
+    """The Solr field to index ``spatial`` bounding boxes in, if any."""
+    return tk.config.get('ckanext.extrafields.solr_spatial_field')
+
+
+def _stored_bbox(pkg_dict):
+    """The bbox saved with the dataset, so big polygons aren't re-parsed."""
+    value = _field_value(pkg_dict, 'spatial_bbox')
+    try:
+        box = json.loads(value) if value else None
+    except ValueError:
+        return None
+    return box if isinstance(box, list) and len(box) == 4 else None
+
+
+def before_index(pkg_dict):
+    """Add typed copies of our extras to the dataset's index document.
+
+    Dates go to ``<field>_date`` so temporal ranges can be queried in Solr,
+    and, if ``ckanext.extrafields.solr_spatial_field`` names a spatial (RPT)
+    field in the Solr schema, the bounding box of ``spatial`` is indexed
+    there as an envelope.
+    """
+    for field in DATE_FIELDS:
+        value = _field_value(pkg_dict, field)
+        if value is None:
+            continue
+        solr_date = to_solr_date(value)
+        if solr_date is None:
+            log.debug(f"Not indexing {field}={value!r}: not a date")
+            continue
+        pkg_dict[field + '_date'] = solr_date
+
+    field = spatial_field()
+    value = _field_value(pkg_dict, 'spatial')
+    if field and value:
+        box = _stored_bbox(pkg_dict)
+        if box is None:
+            try:
+                geometry = spatial.parse_geometry(value)
+                box = spatial.bbox(geometry) if geometry else None
+            except (AttributeError, IndexError, KeyError, TypeError,
+                    ValueError):
+                log.debug("Not indexing spatial: not valid GeoJSON")
+                box = None
+        if box:
+            minx, miny, maxx, maxy = box
+            pkg_dict[field] = f'ENVELOPE({minx}, {maxx}, {maxy}, {miny})'
+    return pkg_dict
+
+
+def before_search(search_params):
+    """Turn ``ext_temporal_start``/``ext_temporal_end`` into a range filter.
+
+    Matches datasets whose temporal coverage overlaps the requested range;
+    either end may be left open.
+    """
+    extras = search_params.get('extras') or {}
+    start = to_solr_date(extras.get('ext_temporal_start'))
+    end = to_solr_date(extras.get('ext_temporal_end'))
+    filters = []
+    if end:
+        filters.append(f'temporal_start_date:[* TO {end}]')
+    if start:
+        filters.append(f'temporal_end_date:[{start} TO *]')
+    if filters:
+        fq = search_params.get('fq') or ''
+        search_params['fq'] = ' '.join([fq] + filters).strip()
+    return search_params
+
+
+# ================================
+# VOCABULARY FACET COUNTS
+# ================================
+
+DEFAULT_FACET_CACHE_TTL = 300
+
+_facet_cache = {}
+_facet_cache_lock = threading.Lock()
+
+
+def facet_cache_ttl():
+    return tk.asint(tk.config.get('ckanext.extrafields.facet_cache_ttl',
+                                  DEFAULT_FACET_CACHE_TTL))
+
+
+def invalidate_facet_counts():
+    with _facet_cache_lock:
+        _facet_cache.clear()
+
+
+def vocabulary_facet_counts(vocabularies):
+    """Return ``{vocabulary: {tag: dataset count}}`` for ``vocabularies``.
+
+    All the counts come from one faceted ``package_search`` over public
+    datasets, cached for ``ckanext.extrafields.facet_cache_ttl`` seconds and
+    dropped whenever a dataset is saved or deleted through this process.
+    """
+    vocabularies = tuple(vocabularies)
+    ttl = facet_cache_ttl()
+    if ttl > 0:
+        with _facet_cache_lock:
+            cached = _facet_cache.get(vocabularies)
+        if cached is not None and time.monotonic() - cached[0] < ttl:
+            metrics.incr('facets.cache.hits')
+            return {vocabulary: dict(counts)
+                    for vocabulary, counts in cached[1].items()}
+
+    metrics.incr('facets.cache.misses')
+    fields = ['vocab_' + vocabulary for vocabulary in vocabularies]
+    result = tk.get_action('package_search')({'ignore_auth': True}, {
+        'q': '*:*',
+        'rows': 0,
+        'facet.field': json.dumps(fields),
+        'facet.limit': -1,
+        'facet.mincount': 1,
+    })
+    search_facets = result.get('search_facets', {})
+    counts = {
+        vocabulary: {item['name']: item['count']
+                     for item in search_facets.get(field, {}).get('items', [])}
+        for vocabulary, field in zip(vocabularies, fields)
+    }
+    if ttl > 0:
+        with _facet_cache_lock:
+            _facet_cache[vocabularies] = (time.monotonic(), counts)
+    return {vocabulary: dict(c) for vocabulary, c in counts.items()}
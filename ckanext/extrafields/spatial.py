@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Helpers for the GeoJSON held in the ``spatial`` extra."""
+
+import json
+import math
+
+# Extras computed from ``spatial`` when a dataset is saved.
+DERIVED_FIELDS = ('spatial_bbox', 'spatial_centroid', 'spatial_simplified')
+
+
+def parse_geometry(value):
+    """Return the GeoJSON geometry in ``value``, or None if it isn't one.
+
+    Accepts a geometry, a Feature or a FeatureCollection (as a dict or a
+    JSON string); features are merged into a GeometryCollection.
+    """
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+    if not isinstance(value, dict):
+        return None
+    kind = value.get('type')
+    if kind == 'Feature':
+        return parse_geometry(value.get('geometry'))
+    if kind == 'FeatureCollection':
+        geometries = [parse_geometry(f) for f in value.get('features') or []]
+        geometries = [g for g in geometries if g is not None]
+        if not geometries:
+            return None
+        return {'type': 'GeometryCollection', 'geometries': geometries}
+    if kind == 'GeometryCollection':
+        return value if value.get('geometries') else None
+    if kind in ('Point', 'MultiPoint', 'LineString', 'MultiLineString',
+                'Polygon', 'MultiPolygon') and value.get('coordinates'):
+        return value
+    return None
+
+
+def _positions(geometry):
+    if geometry['type'] == 'GeometryCollection':
+        for child in geometry['geometries']:
+            yield from _positions(child)
+        return
+    stack = [geometry['coordinates']]
+    while stack:
+        item = stack.pop()
+        if not isinstance(item, list):
+            # Not a coordinate array; skip it rather than loop over a string.
+            continue
+        if item and isinstance(item[0], (int, float)):
+            yield item
+        else:
+            stack.extend(item)
+
+
+def bbox(geometry):
+    """Return ``(minx, miny, maxx, maxy)`` of a parsed geometry."""
+    xs, ys = [], []
+    for position in _positions(geometry):
+        xs.append(float(position[0]))
+        ys.append(float(position[1]))
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _polygons(geometry):
+    """Yield the rings of every polygon in a parsed geometry."""
+    kind = geometry['type']
+    if kind == 'Polygon':
+        yield geometry['coordinates']
+    elif kind == 'MultiPolygon':
+        yield from geometry['coordinates']
+    elif kind == 'GeometryCollection':
+        for child in geometry['geometries']:
+            yield from _polygons(child)
+
+
+def _ring_moments(ring, ox, oy):
+    """Return the area of ``ring`` and its first moments about each axis.
+
+    Coordinates are taken relative to ``(ox, oy)``, which keeps the products
+    small and the result precise far from the origin.
+    """
+    area = mx = my = 0.0
+    for (x0, y0, *_), (x1, y1, *_) in zip(ring, ring[1:]):
+        x0, y0, x1, y1 = x0 - ox, y0 - oy, x1 - ox, y1 - oy
+        cross = x0 * y1 - x1 * y0
+        area += cross
+        mx += (x0 + x1) * cross
+        my += (y0 + y1) * cross
+    # Normalise so that the result doesn't depend on the winding order.
+    if area < 0:
+        area, mx, my = -area, -mx, -my
+    return area / 2, mx / 6, my / 6
+
+
+def centroid(geometry):
+    """Return the ``(x, y)`` centroid of a parsed geometry.
+
+    Polygons are weighted by area, with holes subtracted. Geometries without
+    any area (points and lines) fall back to the mean of their positions.
+    """
+    positions = [(float(p[0]), float(p[1])) for p in _positions(geometry)]
+    if not positions:
+        return None
+    ox, oy = positions[0]
+    area = mx = my = 0.0
+    for rings in _polygons(geometry):
+        for i, ring in enumerate(rings):
+            a, x, y = _ring_moments(ring, ox, oy)
+            sign = 1 if i == 0 else -1
+            area += sign * a
+            mx += sign * x
+            my += sign * y
+    if area > 0:
+        return ox + mx / area, oy + my / area
+    return (sum(x for x, _ in positions) / len(positions),
+            sum(y for _, y in positions) / len(positions))
+
+
+def _simplify_line(points, tolerance):
+    """Douglas-Peucker simplification of a list of positions."""
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    # Iterative rather than recursive, tract boundaries can be very long.
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = points[first][0], points[first][1]
+        bx, by = points[last][0], points[last][1]
+        dx, dy = bx - ax, by - ay
+        length = math.hypot(dx, dy)
+        farthest, distance = None, tolerance
+        for i in range(first + 1, last):
+            px, py = points[i][0], points[i][1]
+            if length:
+                d = abs(dy * px - dx * py + bx * ay - by * ax) / length
+            else:
+                # Closed ring: measure from the shared end point.
+                d = math.hypot(px - ax, py - ay)
+            if d > distance:
+                farthest, distance = i, d
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def _simplify_polygon(rings, tolerance):
+    simplified = []
+    for i, ring in enumerate(rings):
+        ring = _simplify_line(ring, tolerance)
+        if len(ring) >= 4:
+            simplified.append(ring)
+        elif i == 0:
+            # Never lose the outline, however small.
+            simplified.append(rings[0])
+        # Holes smaller than the tolerance are dropped.
+    return simplified
+
+
+def simplify(geometry, tolerance):
+    """Return a copy of a parsed geometry simplified to ``tolerance``.
+
+    ``tolerance`` is in the units of the coordinates (degrees for GeoJSON).
+    """
+    kind = geometry['type']
+    coordinates = geometry.get('coordinates')
+    if kind == 'GeometryCollection':
+        return {'type': kind, 'geometries': [
+            simplify(child, tolerance) for child in geometry['geometries']]}
+    if kind == 'LineString':
+        coordinates = _simplify_line(coordinates, tolerance)
+    elif kind == 'MultiLineString':
+        coordinates = [_simplify_line(line, tolerance)
+                       for line in coordinates]
+    elif kind == 'Polygon':
+        coordinates = _simplify_polygon(coordinates, tolerance)
+    elif kind == 'MultiPolygon':
+        coordinates = [_simplify_polygon(polygon, tolerance)
+                       for polygon in coordinates]
+    return {'type': kind, 'coordinates': coordinates}
+
+
+def derived_fields(geometry, tolerance):
+    """Return the extras derived from a parsed geometry, as JSON strings.
+
+    Returns None for anything that isn't a usable geometry.
+    """
+    if geometry is None or bbox(geometry) is None:
+        return None
+    x, y = centroid(geometry)
+    return {
+        'spatial_bbox': json.dumps(list(bbox(geometry))),
+        'spatial_centroid': json.dumps(
+            {'type': 'Point', 'coordinates': [x, y]}),
+        'spatial_simplified': json.dumps(simplify(geometry, tolerance),
+                                         separators=(',', ':')),
+    }
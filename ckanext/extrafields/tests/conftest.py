@@ -0,0 +1,13 @@
+"""Fixtures shared by the extension's tests."""
+import pytest
+
+import ckanext.extrafields.export as export
+from ckanext.extrafields import metrics
+
+
+@pytest.fixture
+def shared_dir(tmp_path, monkeypatch):
+    """Point the export at an empty directory, with fresh metrics."""
+    monkeypatch.setattr(export, "SHARED_DIR", str(tmp_path))
+    metrics.reset()
+    return tmp_path
@@ -0,0 +1,258 @@
+"""Benchmarks for the extension's hot paths.
+
+These use pytest-benchmark (see dev-requirements.txt) and only run when
+selected with ``-m benchmarks``; see "Benchmarks" in the README for
+recording a baseline and comparing against it.
+"""
+import functools
+import itertools
+import os
+import random
+from unittest import mock
+
+import pytest
+
+import ckan.plugins.toolkit as tk
+from ckan.tests import factories, helpers
+
+import ckanext.extrafields.export as export
+import ckanext.extrafields.plugin as plugin
+
+pytestmark = pytest.mark.benchmarks
+
+TITLES = [
+    u"Median Household Income",
+    u"Población por condado — Florida (2020)",
+    u"Résumé of Hillsborough/Pinellas school-zone boundaries",
+    u"水質 monitoring stations",
+    u"  Leading and trailing spaces  ",
+    u"A very long dataset title " * 20,
+]
+
+RESOURCES = [{"id": "res-{}".format(year), "resource_year_code": str(year)}
+             for year in range(2020, 2030)]
+
+
+def _filenames():
+    for title in TITLES:
+        for resource in RESOURCES:
+            export.get_resource_filename(title, resource)
+
+
+def test_bench_get_resource_filename(benchmark):
+    benchmark(_filenames)
+
+
+def test_bench_sanitize_filename_uncached(benchmark):
+    def run():
+        export._sanitize.cache_clear()
+        for title in TITLES:
+            export.sanitize_filename(title)
+
+    benchmark(run)
+
+
+# ================================
+# SAVE / DELETE THROUGHPUT
+# ================================
+
+RESOURCE_COUNTS = [1, 10, 100]
+
+
+def _resources(count):
+    return [{
+        "url": "http://example.com/data-{}.csv".format(i),
+        "name": "Data {}".format(i),
+        "format": "CSV",
+        "resource_year_code": str(2000 + i),
+        "census_geo_year_code": "2020",
+        "terria_catalogue": "yes",
+        "point_or_polygon": "polygon",
+    } for i in range(count)]
+
+
+def _dataset_dict(count):
+    resources = _resources(count)
+    for i, resource in enumerate(resources):
+        resource["id"] = "resource-{}".format(i)
+    return {"id": "bench-dataset", "name": "bench-dataset",
+            "title": u"Benchmark Dataset", "resources": resources}
+
+
+# The hook benchmarks run the chained actions against a stubbed core action,
+# so they measure only what the extension adds to each save.
+
+@pytest.mark.ckan_config("ckanext.extrafields.export.skip_unchanged", "false")
+@pytest.mark.parametrize("count", RESOURCE_COUNTS)
+def test_bench_package_create_hook(benchmark, shared_dir, count):
+    dataset = _dataset_dict(count)
+    benchmark(plugin.package_create, lambda context, data_dict: dataset,
+              {}, {})
+
+
+@pytest.mark.parametrize("count", RESOURCE_COUNTS)
+def test_bench_package_update_hook_unchanged(benchmark, shared_dir, count):
+    dataset = _dataset_dict(count)
+    plugin.package_update(lambda context, data_dict: dataset, {}, {})
+    benchmark(plugin.package_update, lambda context, data_dict: dataset,
+              {}, {})
+
+
+@pytest.mark.parametrize("count", RESOURCE_COUNTS)
+def test_bench_remove_dataset_exports(benchmark, shared_dir, count):
+    dataset = _dataset_dict(count)
+
+    def setup():
+        export.export_dataset(dataset, "create")
+        return (dataset["id"], dataset["title"], dataset["resources"]), {}
+
+    benchmark.pedantic(export.remove_dataset_exports, setup=setup, rounds=20)
+
+
+# End-to-end benchmarks through the real actions and the dataset form. These
+# need the CKAN test database and search index.
+
+@pytest.mark.ckan_config("ckan.plugins", "extrafields")
+@pytest.mark.usefixtures("clean_db", "clean_index", "with_plugins")
+class TestActionBenchmarks(object):
+
+    @pytest.mark.parametrize("count", RESOURCE_COUNTS)
+    def test_bench_package_create(self, benchmark, shared_dir, count):
+        names = ("bench-create-{}".format(i) for i in itertools.count())
+
+        def create():
+            helpers.call_action("package_create", name=next(names),
+                                title=u"Benchmark", resources=_resources(count))
+
+        benchmark.pedantic(create, rounds=10)
+
+    @pytest.mark.parametrize("count", RESOURCE_COUNTS)
+    def test_bench_package_update(self, benchmark, shared_dir, count):
+        dataset = factories.Dataset(resources=_resources(count))
+        notes = ("revision {}".format(i) for i in itertools.count())
+
+        def update():
+            dataset["notes"] = next(notes)
+            helpers.call_action("package_update", **dataset)
+
+        benchmark.pedantic(update, rounds=10)
+
+    def test_bench_resource_delete(self, benchmark, shared_dir):
+        def setup():
+            dataset = factories.Dataset(resources=_resources(10))
+            return (), {"id": dataset["resources"][0]["id"]}
+
+        benchmark.pedantic(
+            functools.partial(helpers.call_action, "resource_delete"),
+            setup=setup, rounds=10)
+
+    @pytest.mark.parametrize("count", RESOURCE_COUNTS)
+    def test_bench_package_delete(self, benchmark, shared_dir, count):
+        def setup():
+            dataset = factories.Dataset(resources=_resources(count))
+            return (), {"id": dataset["id"]}
+
+        benchmark.pedantic(
+            functools.partial(helpers.call_action, "package_delete"),
+            setup=setup, rounds=10)
+
+    def test_bench_edit_form(self, benchmark, app):
+        plugin.seed_vocabularies()
+        user = factories.Sysadmin()
+        dataset = factories.Dataset(resources=_resources(10))
+        url = tk.url_for("dataset.edit", id=dataset["name"])
+
+        def render():
+            response = app.get(url,
+                               extra_environ={"REMOTE_USER": user["name"]})
+            assert response.status_code == 200
+
+        benchmark(render)
+
+
+# ================================
+# PACKAGE SCHEMAS
+# ================================
+
+def test_bench_show_package_schema(benchmark):
+    benchmark(plugin.ExampleIDatasetFormPlugin().show_package_schema)
+
+
+@pytest.mark.ckan_config("ckan.plugins", "extrafields")
+@pytest.mark.usefixtures("clean_db", "clean_index", "with_plugins")
+def test_bench_package_show(benchmark):
+    dataset = factories.Dataset(resources=_resources(10))
+    benchmark(helpers.call_action, "package_show", id=dataset["id"])
+
+
+# ================================
+# EXPORT DIRECTORY LAYOUT
+# ================================
+
+LAYOUTS = ["flat", "hashed", "dataset"]
+# Filling the 100k directories writes over 300k files, so they only run
+# when EXTRAFIELDS_BENCH_LARGE is set.
+FILE_COUNTS = [10000, pytest.param(100000, marks=pytest.mark.skipif(
+    not os.environ.get("EXTRAFIELDS_BENCH_LARGE"),
+    reason="set EXTRAFIELDS_BENCH_LARGE=1 to benchmark 100k files"))]
+YEARS = 10
+
+_populated = {}
+
+
+@pytest.fixture
+def populated_dir(request, tmp_path_factory, monkeypatch):
+    """An export directory holding ``count`` files in ``layout``.
+
+    Filling it is slow, so each one is built once per session.
+    """
+    layout, count = request.node.callspec.params["layout"], \
+        request.node.callspec.params["files"]
+    key = (layout, count)
+    if key not in _populated:
+        directory = tmp_path_factory.mktemp("{}-{}".format(layout, count))
+        for i in range(count // YEARS):
+            for year in range(YEARS):
+                path = directory / export.shard_path(
+                    "Dataset_{}__{}.json".format(i, 2000 + year), layout)
+                path.parent.mkdir(exist_ok=True)
+                path.write_bytes(b"{}")
+        _populated[key] = str(directory)
+    monkeypatch.setattr(export, "SHARED_DIR", _populated[key])
+    with mock.patch.object(export, "export_layout", return_value=layout):
+        yield _populated[key]
+
+
+@pytest.mark.parametrize("files", FILE_COUNTS)
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_bench_layout_resolve(benchmark, populated_dir, layout, files):
+    names = [(u"Dataset {}".format(random.randrange(files // YEARS)),
+              {"resource_year_code": str(2000 + random.randrange(YEARS))})
+             for _ in range(1000)]
+
+    def resolve():
+        for title, resource in names:
+            os.stat(os.path.join(populated_dir, export.get_resource_filename(
+                title, resource)))
+
+    benchmark(resolve)
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.export.skip_unchanged", "false")
+@pytest.mark.parametrize("files", FILE_COUNTS)
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_bench_layout_write(benchmark, populated_dir, layout, files):
+    dataset = {"id": "bench-layout", "name": "bench-layout",
+               "title": u"Dataset 0",
+               "resources": [{"id": "bench-layout-res",
+                              "resource_year_code": "2000"}]}
+    benchmark(export.write_dataset_json, dataset, "update")
+
+
+@pytest.mark.parametrize("files", FILE_COUNTS)
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_bench_layout_list(benchmark, populated_dir, layout, files):
+    # What a consumer looking for one dataset's files has to read.
+    directory = os.path.dirname(os.path.join(
+        populated_dir, export.shard_path("Dataset_0__2000.json", layout)))
+    benchmark(os.listdir, directory)
@@ -0,0 +1,601 @@
+"""Tests for export.py."""
+import gzip
+import json
+import multiprocessing
+import os
+import random
+import re
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+import ckanext.extrafields.export as export
+from ckanext.extrafields import metrics
+
+
+def _dataset(title=u"Median Income", years=(u"2020", u"2021")):
+    return {
+        "id": "dataset-id",
+        "name": "median-income",
+        "title": title,
+        "resources": [
+            {"id": "res-{}".format(year), "resource_year_code": year}
+            for year in years
+        ],
+    }
+
+
+def test_export_dataset_writes_one_file_per_resource(shared_dir):
+    export.export_dataset(_dataset(), "create")
+
+    assert sorted(p.name for p in shared_dir.glob("*.json")) == [
+        "Median_Income__2020.json", "Median_Income__2021.json"]
+    data = json.loads((shared_dir / "Median_Income__2020.json").read_text())
+    assert data["action"] == "create"
+    assert data["resource"]["id"] == "res-2020"
+
+
+def test_unchanged_resources_are_skipped(shared_dir):
+    dataset = _dataset()
+    export.export_dataset(dataset, "update")
+    path = shared_dir / "Median_Income__2020.json"
+    size = path.stat().st_size
+    mtime = path.stat().st_mtime_ns
+
+    dataset["resources"][1]["format"] = "CSV"
+    export.export_dataset(dataset, "update")
+
+    assert path.stat().st_mtime_ns == mtime
+    counters = metrics.snapshot()["counters"]
+    assert counters["export.files.written"] == 3
+    assert counters["export.files.skipped"] == 1
+    assert counters["export.bytes_saved"] == size
+
+
+def test_deleted_files_are_rewritten(shared_dir):
+    dataset = _dataset(years=(u"2020",))
+    export.export_dataset(dataset, "update")
+    (shared_dir / "Median_Income__2020.json").unlink()
+
+    export.export_dataset(dataset, "update")
+
+    assert (shared_dir / "Median_Income__2020.json").exists()
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.export.skip_unchanged", "false")
+def test_skip_unchanged_can_be_disabled(shared_dir):
+    export.export_dataset(_dataset(), "update")
+    export.export_dataset(_dataset(), "update")
+
+    assert metrics.snapshot()["counters"]["export.files.written"] == 4
+
+
+def test_content_hash_ignores_timestamp_and_action():
+    payload = {"resource": {"id": "x"}, "timestamp": "2024-01-01T00:00:00",
+               "action": "create"}
+    other = dict(payload, timestamp="2025-01-01T00:00:00", action="update")
+    assert export.content_hash(payload) == export.content_hash(other)
+
+
+def test_unchanged_update_after_create_is_skipped(shared_dir):
+    export.export_dataset(_dataset(), "create")
+    export.export_dataset(_dataset(), "update")
+
+    counters = metrics.snapshot()["counters"]
+    assert counters["export.files.written"] == 2
+    assert counters["export.files.skipped"] == 2
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.export.async", "true")
+def test_async_export_is_flushed_in_order(shared_dir):
+    dataset = _dataset()
+    export.export_dataset(dataset, "create")
+    export.remove_dataset_exports(
+        dataset["id"], dataset["title"], dataset["resources"][:1])
+    export.get_export_queue().flush()
+
+    assert [p.name for p in shared_dir.glob("*.json")] == [
+        "Median_Income__2021.json"]
+    assert metrics.snapshot()["counters"]["export.queue.enqueued"] == 2
+
+
+def test_full_queue_waits_and_keeps_order(shared_dir):
+    export_queue = export.ExportQueue(workers=1, queue_size=1)
+    release = threading.Event()
+    ran = []
+    try:
+        export_queue.submit("a", release.wait)
+        # Let the worker pick up the blocking job so the queue is empty.
+        while export_queue.depth():
+            pass
+        export_queue.submit("a", ran.append, 1)
+        submitter = threading.Thread(target=export_queue.submit,
+                                     args=("a", ran.append, 2))
+        submitter.start()
+        submitter.join(0.2)
+        # The second job neither ran ahead of the first nor was dropped.
+        assert submitter.is_alive()
+        assert ran == []
+        assert metrics.snapshot()["counters"]["export.queue.overflowed"] == 1
+        release.set()
+        submitter.join(5)
+    finally:
+        release.set()
+        export_queue.stop()
+    assert ran == [1, 2]
+
+
+@pytest.mark.parametrize("mode", export.DURABILITY_MODES)
+def test_write_batch_replaces_files_atomically(shared_dir, mode):
+    target = shared_dir / "data.json"
+    target.write_bytes(b"old")
+
+    with export.WriteBatch(mode) as batch:
+        batch.write(str(target), b"new")
+        if mode == "batch":
+            assert target.read_bytes() == b"old"
+
+    assert target.read_bytes() == b"new"
+    assert [p.name for p in shared_dir.iterdir()] == ["data.json"]
+
+
+def test_write_batch_abort_keeps_old_files(shared_dir):
+    target = shared_dir / "data.json"
+    target.write_bytes(b"old")
+
+    with pytest.raises(RuntimeError):
+        with export.WriteBatch("batch") as batch:
+            batch.write(str(target), b"new")
+            raise RuntimeError()
+
+    assert target.read_bytes() == b"old"
+    assert [p.name for p in shared_dir.iterdir()] == ["data.json"]
+
+
+@pytest.mark.parametrize("mode, fsyncs", [("file", 4), ("batch", 3),
+                                           ("none", 0)])
+def test_fsyncs_per_durability_mode(shared_dir, mode, fsyncs):
+    with export.WriteBatch(mode) as batch:
+        batch.write(str(shared_dir / "a.json"), b"a")
+        batch.write(str(shared_dir / "b.json"), b"b")
+
+    assert metrics.snapshot()["counters"].get("export.fsyncs", 0) == fsyncs
+
+
+def test_no_fsyncs_by_default(shared_dir):
+    export.export_dataset(_dataset(), "create")
+
+    assert "export.fsyncs" not in metrics.snapshot()["counters"]
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.export.format", "compact")
+def test_compact_format(shared_dir):
+    export.export_dataset(_dataset(years=(u"2020",)), "create")
+
+    text = (shared_dir / "Median_Income__2020.json").read_text()
+    assert "\n" not in text
+    assert json.loads(text)["resource"]["id"] == "res-2020"
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.export.gzip", "true")
+def test_gzip_export_and_delete(shared_dir):
+    dataset = _dataset(years=(u"2020",))
+    export.export_dataset(dataset, "create")
+
+    path = shared_dir / "Median_Income__2020.json.gz"
+    data = json.loads(gzip.decompress(path.read_bytes()))
+    assert data["resource"]["id"] == "res-2020"
+
+    export.remove_dataset_exports(
+        dataset["id"], dataset["title"], dataset["resources"])
+    assert not path.exists()
+
+
+def test_encode_payload_formats_round_trip():
+    payload = {"title": u"Año", "values": [1, 2.5, None]}
+    for fmt in export.EXPORT_FORMATS:
+        for compress in (False, True):
+            encoded = export.encode_payload(payload, fmt, compress)
+            if compress:
+                encoded = gzip.decompress(encoded)
+            assert json.loads(encoded) == payload
+
+
+def _package_search(datasets):
+    """A package_search over ``datasets`` that honours the keyset filter."""
+    def package_search(context, data_dict):
+        assert data_dict["sort"] == "id asc"
+        found = sorted(datasets, key=lambda d: d["id"])
+        match = re.match(r'id:\{"(.*)" TO \*\]$', data_dict.get("fq", ""))
+        if match:
+            found = [d for d in found if d["id"] > match.group(1)]
+        return {"count": len(found), "results": found[:data_dict["rows"]]}
+    return package_search
+
+
+def test_iter_datasets_survives_deletes_between_pages():
+    datasets = [{"id": "dataset-{}".format(i)} for i in range(5)]
+    search = _package_search(datasets)
+
+    def package_search(context, data_dict):
+        result = search(context, data_dict)
+        if "fq" not in data_dict:
+            # Another request deletes a dataset from the first page.
+            del datasets[0]
+        return result
+
+    with mock.patch.object(export.tk, "get_action",
+                           return_value=package_search):
+        seen = [d["id"] for d in export.iter_datasets({}, page_size=2)]
+    assert seen == ["dataset-{}".format(i) for i in range(5)]
+
+
+def test_export_all_rebuilds_and_prunes(shared_dir):
+    datasets = [_dataset(title=u"Dataset {}".format(i), years=(u"2020",))
+                for i in range(5)]
+    for i, dataset in enumerate(datasets):
+        dataset["id"] = "dataset-{}".format(i)
+        dataset["resources"][0]["id"] = "res-{}".format(i)
+    (shared_dir / "Deleted_Dataset__2019.json").write_text(u"{}")
+    old = time.time() - 60
+    os.utime(str(shared_dir / "Deleted_Dataset__2019.json"), (old, old))
+
+    package_search = _package_search(datasets)
+
+    with mock.patch.object(export.tk, "get_action",
+                           return_value=package_search):
+        summary = export.export_all({}, workers=2, page_size=2)
+        assert summary["datasets"] == 5
+        assert summary["written"] == 5
+        assert summary["removed"] == 1
+
+        summary = export.export_all({}, workers=2, page_size=2)
+        assert summary["skipped"] == 5
+        assert "written" not in summary
+
+    assert sorted(p.name for p in shared_dir.glob("*.json")) == [
+        "Dataset_{}__2020.json".format(i) for i in range(5)]
+
+
+def test_renamed_dataset_replaces_old_file(shared_dir):
+    dataset = _dataset(years=(u"2020",))
+    export.export_dataset(dataset, "create")
+
+    dataset["title"] = u"Median Household Income"
+    export.export_dataset(dataset, "update")
+
+    assert [p.name for p in shared_dir.glob("*.json")] == [
+        "Median_Household_Income__2020.json"]
+    assert metrics.snapshot()["counters"]["export.files.renamed"] == 1
+
+
+def test_same_year_code_does_not_overwrite(shared_dir):
+    dataset = _dataset(years=(u"2020", u"2020"))
+    dataset["resources"][1]["id"] = "other-resource"
+    export.export_dataset(dataset, "create")
+
+    assert sorted(p.name for p in shared_dir.glob("*.json")) == [
+        "Median_Income__2020.json", "Median_Income__2020__other-re.json"]
+    assert metrics.snapshot()["counters"]["export.files.collisions"] == 1
+
+    # Exporting again keeps every resource on the file it already has.
+    export.export_dataset(dataset, "create")
+    assert len(list(shared_dir.glob("*.json"))) == 2
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.export.fsync", "batch")
+def test_same_year_code_in_one_batch(shared_dir):
+    dataset = _dataset(years=(u"2020", u"2020"))
+    dataset["resources"][1]["id"] = "other-resource"
+    export.export_dataset(dataset, "create")
+
+    assert sorted(p.name for p in shared_dir.glob("*.json")) == [
+        "Median_Income__2020.json", "Median_Income__2020__other-re.json"]
+
+
+def test_failed_write_leaves_index_alone(shared_dir):
+    with mock.patch.object(export.os, "replace", side_effect=OSError):
+        export.export_dataset(_dataset(years=(u"2020",)), "create")
+
+    export_index = export.get_index(str(shared_dir))
+    assert export_index.filename_for("res-2020") is None
+    assert export_index.owner_of("Median_Income__2020.json") is None
+    assert not list(shared_dir.glob("*.json"))
+
+
+def test_delete_finds_file_by_resource_id(shared_dir):
+    dataset = _dataset(years=(u"2020",))
+    export.export_dataset(dataset, "create")
+
+    # The caller's idea of the title is out of date.
+    export.remove_dataset_exports(
+        dataset["id"], u"Old title", dataset["resources"])
+
+    assert list(shared_dir.glob("*.json")) == []
+
+
+def test_dataset_files_share_one_header(shared_dir):
+    export.export_dataset(_dataset(), "create")
+
+    payloads = [json.loads(p.read_text())
+                for p in sorted(shared_dir.glob("*.json"))]
+    assert payloads[0]["timestamp"] == payloads[1]["timestamp"]
+    assert payloads[0]["dataset"] == payloads[1]["dataset"]
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.export.manifest", "true")
+def test_dataset_manifest(shared_dir):
+    dataset = _dataset()
+    export.export_dataset(dataset, "create")
+
+    manifest = json.loads(
+        (shared_dir / "Median_Income.manifest.json").read_text())
+    assert [r["id"] for r in manifest["resources"]] == [
+        "res-2020", "res-2021"]
+    assert manifest["dataset"]["name"] == "median-income"
+
+    export.remove_dataset_exports(
+        dataset["id"], dataset["title"], dataset["resources"], manifest=True)
+    assert list(shared_dir.glob("*.json")) == []
+
+
+def _catalog(shared_dir):
+    return json.loads((shared_dir / "terria-catalog.json").read_text())
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.terria_catalog", "true")
+def test_terria_catalog_is_maintained_incrementally(shared_dir):
+    dataset = _dataset(years=(u"2020", u"2021", u"2022"))
+    dataset["resources"][0]["terria_catalogue"] = "yes"
+    dataset["resources"][2]["terria_catalogue"] = "yes"
+    other = _dataset(title=u"Age", years=(u"2020",))
+    other["id"] = "other-id"
+    other["resources"][0]["id"] = "other-res"
+
+    export.export_dataset(dataset, "create")
+    export.export_dataset(other, "create")
+    catalog = _catalog(shared_dir)
+    assert [d["id"] for d in catalog["datasets"]] == ["dataset-id"]
+    entry = catalog["datasets"][0]
+    assert list(entry["years"]) == ["2020", "2022"]
+    assert entry["years"]["2020"][0]["id"] == "res-2020"
+    assert entry["years"]["2020"][0]["file"] == "Median_Income__2020.json"
+
+    # Saving without catalog changes leaves the file alone.
+    dataset["resources"][1]["format"] = "CSV"
+    export.export_dataset(dataset, "update")
+    other["resources"][0]["terria_catalogue"] = "yes"
+    export.export_dataset(other, "update")
+    assert [d["title"] for d in _catalog(shared_dir)["datasets"]] == [
+        "Age", "Median Income"]
+    assert metrics.snapshot()["counters"]["export.catalog.renders"] == 2
+
+    export.remove_dataset_exports("dataset-id", u"Median Income",
+                                  [{"id": "res-2020"}])
+    entry = _catalog(shared_dir)["datasets"][1]
+    assert list(entry["years"]) == ["2022"]
+
+    export.remove_dataset_exports("other-id", u"Age", [{"id": "other-res"}],
+                                  manifest=True)
+    assert [d["id"] for d in _catalog(shared_dir)["datasets"]] == [
+        "dataset-id"]
+
+
+def test_terria_catalog_is_off_by_default(shared_dir):
+    dataset = _dataset()
+    dataset["resources"][0]["terria_catalogue"] = "yes"
+    export.export_dataset(dataset, "create")
+    assert not (shared_dir / "terria-catalog.json").exists()
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.terria_catalog", "true")
+def test_export_all_renders_catalog_once(shared_dir):
+    datasets = [_dataset(title=u"Dataset {}".format(i), years=(u"2020",))
+                for i in range(3)]
+    for i, dataset in enumerate(datasets):
+        dataset["id"] = "dataset-{}".format(i)
+        dataset["resources"][0]["id"] = "res-{}".format(i)
+        dataset["resources"][0]["terria_catalogue"] = "yes"
+
+    package_search = _package_search(datasets)
+
+    with mock.patch.object(export.tk, "get_action",
+                           return_value=package_search):
+        export.export_all({}, workers=2)
+        del datasets[1]
+        export.export_all({}, workers=2)
+
+    assert [d["id"] for d in _catalog(shared_dir)["datasets"]] == [
+        "dataset-0", "dataset-2"]
+    assert metrics.snapshot()["counters"]["export.catalog.renders"] == 2
+
+
+def test_older_payload_does_not_replace_newer(shared_dir):
+    newer = _dataset(years=(u"2020",))
+    newer["resources"][0]["metadata_modified"] = "2024-05-01T12:00:00.000002"
+    newer["resources"][0]["format"] = "CSV"
+    older = _dataset(years=(u"2020",))
+    older["resources"][0]["metadata_modified"] = "2024-05-01T12:00:00.000001"
+    older["resources"][0]["format"] = "XLSX"
+
+    assert export.write_dataset_json(newer, "update") == ["written"]
+    assert export.write_dataset_json(older, "update") == ["stale"]
+
+    data = json.loads((shared_dir / "Median_Income__2020.json").read_text())
+    assert data["resource"]["format"] == "CSV"
+    assert metrics.snapshot()["counters"]["export.files.stale"] == 1
+
+
+def test_dataset_modified_orders_dataset_level_changes(shared_dir):
+    dataset = _dataset(years=(u"2020",))
+    dataset["resources"][0]["metadata_modified"] = "2024-05-01T00:00:00"
+    dataset["metadata_modified"] = "2024-05-03T00:00:00"
+    export.write_dataset_json(dataset, "update")
+
+    dataset["metadata_modified"] = "2024-05-02T00:00:00"
+    assert export.write_dataset_json(dataset, "update") == ["stale"]
+
+
+def test_late_export_does_not_bring_back_deleted_file(shared_dir):
+    dataset = _dataset(years=(u"2020",))
+    dataset["metadata_modified"] = "2024-05-02T00:00:00"
+    newer = export.write_dataset_json(dataset, "update")
+    export.remove_dataset_exports("dataset-id", u"Median Income",
+                                  [{"id": "res-2020"}])
+
+    dataset["metadata_modified"] = "2024-05-01T00:00:00"
+    assert newer + export.write_dataset_json(dataset, "update") == [
+        "written", "stale"]
+    assert not (shared_dir / "Median_Income__2020.json").exists()
+
+
+def test_delete_time_is_kept_for_late_exports(shared_dir):
+    export.remove_dataset_exports("dataset-id", u"Median Income",
+                                  [{"id": "res-2020"}],
+                                  modified="2024-05-02T00:00:00")
+    dataset = _dataset(years=(u"2020",))
+    dataset["metadata_modified"] = "2024-05-02T00:00:00"
+    assert export.write_dataset_json(dataset, "update") == ["stale"]
+
+    dataset["metadata_modified"] = "2024-05-03T00:00:00"
+    assert export.write_dataset_json(dataset, "update") == ["written"]
+    assert (shared_dir / "Median_Income__2020.json").exists()
+
+
+def _hammer(directory, timestamps):
+    export.SHARED_DIR = directory
+    for timestamp in timestamps:
+        dataset = _dataset(years=(u"2020", u"2021"))
+        for resource in dataset["resources"]:
+            resource["metadata_modified"] = timestamp
+            resource["description"] = timestamp
+        export.write_dataset_json(dataset, "update")
+
+
+def test_concurrent_writers_keep_newest_version(shared_dir):
+    processes, writes = 6, 30
+    timestamps = ["2024-05-01T12:00:00.{:06d}".format(n)
+                  for n in range(processes * writes)]
+    context = multiprocessing.get_context("fork")
+    workers = []
+    for k in range(processes):
+        mine = timestamps[k::processes]
+        random.shuffle(mine)
+        workers.append(context.Process(target=_hammer,
+                                       args=(str(shared_dir), mine)))
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    assert sorted(p.name for p in shared_dir.iterdir()
+                  if not p.name.startswith(".")) == [
+        "Median_Income__2020.json", "Median_Income__2021.json"]
+    for name in ("Median_Income__2020.json", "Median_Income__2021.json"):
+        data = json.loads((shared_dir / name).read_text())
+        assert data["resource"]["description"] == timestamps[-1]
+    assert not list(shared_dir.glob(".*.tmp"))
+
+
+@pytest.mark.parametrize("layout, expected", [
+    ("flat", "Median_Income__2020.json"),
+    ("hashed", "{:02x}/Median_Income__2020.json".format(
+        export.zlib.crc32(b"Median_Income__2020.json") % 256)),
+    ("dataset", "Median_Income/Median_Income__2020.json"),
+])
+def test_layouts(shared_dir, layout, expected):
+    with mock.patch.object(export, "export_layout", return_value=layout):
+        export.write_dataset_json(_dataset(years=(u"2020",)), "create")
+        assert (shared_dir / expected).is_file()
+
+        export.remove_dataset_exports("dataset-id", u"Median Income",
+                                      [{"id": "res-2020"}])
+        assert not (shared_dir / expected).exists()
+
+
+def test_dataset_layout_manifest(shared_dir):
+    assert export.shard_path("Median_Income.manifest.json", "dataset") == \
+        "Median_Income/Median_Income.manifest.json"
+
+
+@pytest.mark.parametrize("title", [
+    u"Median Household Income",
+    u"Población por condado — Florida (2020)",
+    u"Résumé of Hillsborough/Pinellas school-zone boundaries",
+    u"水質 monitoring stations",
+    u"  Leading and trailing spaces  ",
+    u"A very long dataset title " * 20,
+])
+def test_sanitize_filename_is_safe(title):
+    safe = export.sanitize_filename(title)
+    assert safe
+    assert all(c.isascii() and (c.isalnum() or c in "-_.") for c in safe)
+    assert "__" not in safe
+
+
+def test_sanitize_filename_examples():
+    assert export.sanitize_filename(u"Población 2020") == "Poblaci_n_2020"
+    assert export.sanitize_filename(u"  / ") == "untitled"
+    assert export.sanitize_filename(2020) == "2020"
+
+
+@pytest.mark.parametrize("title, expected", [
+    (u"..", "untitled"),
+    (u".hidden", "hidden"),
+    (u"._.Report", "Report"),
+])
+def test_sanitize_filename_drops_leading_dots(title, expected):
+    assert export.sanitize_filename(title) == expected
+
+
+@pytest.mark.parametrize("basename, expected", [
+    ("..__2020.json", "untitled/..__2020.json"),
+    (".hidden__2020.json", "hidden/.hidden__2020.json"),
+    ("...manifest.json", "untitled/...manifest.json"),
+])
+def test_dataset_layout_stays_in_shared_dir(basename, expected):
+    assert export.shard_path(basename, "dataset") == expected
+
+
+@pytest.mark.parametrize("layout", ["hashed", "dataset"])
+def test_collision_names_are_resharded(shared_dir, layout):
+    dataset = _dataset(years=(u"2020",))
+    dataset["resources"].append({"id": "other-2020",
+                                 "resource_year_code": u"2020"})
+    with mock.patch.object(export, "export_layout", return_value=layout):
+        export.export_dataset(dataset, "create")
+
+    claimed = export.shard_path("Median_Income__2020__other-20.json", layout)
+    assert (shared_dir / claimed).is_file()
+    assert export.get_index(str(shared_dir)).filename_for(
+        "other-2020") == claimed
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.terria_catalog", "true")
+def test_migrate_layout(shared_dir):
+    dataset = _dataset()
+    dataset["resources"][0]["terria_catalogue"] = "yes"
+    export.write_dataset_json(dataset, "create")
+
+    assert export.migrate_layout("dataset") == 2
+    assert sorted(str(p.relative_to(shared_dir))
+                  for p in shared_dir.rglob("*.json")) == [
+        "Median_Income/Median_Income__2020.json",
+        "Median_Income/Median_Income__2021.json",
+        "terria-catalog.json"]
+    entry = _catalog(shared_dir)["datasets"][0]
+    assert entry["years"]["2020"][0]["file"] == \
+        "Median_Income/Median_Income__2020.json"
+
+    # Deletes find the moved files through the index.
+    export.remove_dataset_exports("dataset-id", u"Median Income",
+                                  [{"id": "res-2020"}])
+    assert not (shared_dir / "Median_Income" /
+                "Median_Income__2020.json").exists()
+
+    assert export.migrate_layout("flat") == 1
+    assert not (shared_dir / "Median_Income").exists()
+    assert (shared_dir / "Median_Income__2021.json").is_file()
@@ -0,0 +1,74 @@
+"""Tests for journal.py."""
+import json
+
+import pytest
+
+import ckanext.extrafields.export as export
+from ckanext.extrafields.index import ExportIndex
+from ckanext.extrafields.journal import Journal
+
+
+def _read(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.journal", "true")
+def test_export_events_are_journaled(shared_dir):
+    dataset = {"id": "dataset-id", "name": "income", "title": u"Income",
+               "resources": [{"id": "res-1", "resource_year_code": u"2020"}]}
+    export.export_dataset(dataset, "create")
+    export.export_dataset(dataset, "update")
+    dataset["resources"][0]["format"] = "CSV"
+    export.export_dataset(dataset, "update")
+    export.remove_dataset_exports(
+        dataset["id"], dataset["title"], dataset["resources"])
+
+    entries = _read(shared_dir / ".journal" / "changes.ndjson")
+    assert [(e["seq"], e["event"], e["file"]) for e in entries] == [
+        (1, "create", "Income__2020.json"),
+        (2, "update", "Income__2020.json"),
+        (3, "delete", "Income__2020.json"),
+    ]
+    assert entries[0]["resource_id"] == "res-1"
+    assert entries[0]["hash"] != entries[1]["hash"]
+    assert entries[2]["hash"] is None
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.journal", "true")
+def test_new_files_are_journaled_as_created(shared_dir):
+    dataset = {"id": "dataset-id", "name": "income", "title": u"Income",
+               "resources": [{"id": "res-1", "resource_year_code": u"2020"}]}
+    export.export_dataset(dataset, "create")
+    dataset["resources"].append({"id": "res-2",
+                                 "resource_year_code": u"2021"})
+    export.export_dataset(dataset, "update")
+    dataset["title"] = u"Median Income"
+    export.export_dataset(dataset, "update")
+
+    entries = _read(shared_dir / ".journal" / "changes.ndjson")
+    assert [(e["event"], e["file"]) for e in entries] == [
+        ("create", "Income__2020.json"),
+        ("create", "Income__2021.json"),
+        ("delete", "Income__2020.json"),
+        ("create", "Median_Income__2020.json"),
+        ("delete", "Income__2021.json"),
+        ("create", "Median_Income__2021.json"),
+    ]
+
+
+def test_journal_disabled_by_default(shared_dir):
+    export.export_dataset({"id": "d", "title": u"T", "resources": [
+        {"id": "r", "resource_year_code": u"2020"}]}, "create")
+    assert not (shared_dir / ".journal").exists()
+
+
+def test_journal_rotation(tmp_path):
+    journal = Journal(str(tmp_path / "journal"), ExportIndex(str(tmp_path)),
+                      max_bytes=1, keep=2)
+    for i in range(4):
+        journal.append([{"event": "update", "file": "{}.json".format(i)}])
+
+    rotated = sorted(p.name for p in (tmp_path / "journal").glob("changes-*"))
+    assert rotated == ["changes-000000000003.ndjson",
+                       "changes-000000000004.ndjson"]
+    assert _read(tmp_path / "journal" / rotated[-1])[0]["seq"] == 4
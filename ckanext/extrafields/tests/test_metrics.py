@@ -0,0 +1,67 @@
+"""Tests for metrics.py."""
+import socket
+
+import pytest
+
+from ckanext.extrafields import metrics
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+    metrics.configure({})
+
+
+def test_timer_records_histogram():
+    with metrics.timer("export.file_write"):
+        pass
+    metrics.observe("export.file_write", 0.3)
+
+    histogram = metrics.snapshot()["histograms"]["export.file_write"]
+    assert histogram["count"] == 2
+    assert histogram["sum"] >= 0.3
+
+
+def test_render_prometheus():
+    metrics.incr("export.files.written", 3)
+    metrics.set_gauge("export.queue.depth", 7)
+    metrics.observe("action.package_update.core", 0.02)
+    metrics.observe("action.package_update.core", 20)
+
+    text = metrics.render_prometheus()
+
+    assert "ckanext_extrafields_export_files_written_total 3\n" in text
+    assert "ckanext_extrafields_export_queue_depth 7\n" in text
+    name = "ckanext_extrafields_action_package_update_core_seconds"
+    assert "# TYPE {} histogram".format(name) in text
+    assert '{}_bucket{{le="0.01"}} 0\n'.format(name) in text
+    assert '{}_bucket{{le="0.025"}} 1\n'.format(name) in text
+    assert '{}_bucket{{le="10.0"}} 1\n'.format(name) in text
+    assert '{}_bucket{{le="+Inf"}} 2\n'.format(name) in text
+    assert "{}_count 2\n".format(name) in text
+
+
+def test_statsd_emitter():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(5)
+    port = server.getsockname()[1]
+    try:
+        metrics.configure({
+            "ckanext.extrafields.statsd_host": "127.0.0.1:{}".format(port),
+            "ckanext.extrafields.statsd_prefix": "ckan"})
+        metrics.incr("export.files.written")
+        metrics.observe("export.dataset", 0.5)
+
+        assert server.recv(1024) == b"ckan.export.files.written:1|c"
+        assert server.recv(1024) == b"ckan.export.dataset:500.000|ms"
+    finally:
+        server.close()
+
+
+def test_statsd_bad_port_falls_back_to_default():
+    metrics.configure({"ckanext.extrafields.statsd_host": "localhost:abc"})
+    assert metrics._statsd.address == (
+        "localhost", metrics.DEFAULT_STATSD_PORT)
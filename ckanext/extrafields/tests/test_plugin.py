@@ -47,7 +47,410 @@ To temporary patch the CKAN configuration for the duration of a test you can use
     def test_some_action():
         pass
 """
+import json
+from unittest import mock
+import pytest
+
+import ckan.lib.plugins as lib_plugins
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+from ckan.tests import factories, helpers
+
 import ckanext.extrafields.plugin as plugin
+from ckanext.extrafields import export
 
 def test_plugin():
     pass
+
+
+def test_bad_log_level_does_not_stop_startup():
+    plugin.ExampleIDatasetFormPlugin().configure({
+        "ckanext.extrafields.log_level": "LOUD",
+        "ckanext.extrafields.seed_vocabularies_on_startup": "false"})
+
+
+@pytest.fixture
+def vocab_cache():
+    plugin.invalidate_vocabulary_cache()
+    yield
+    plugin.invalidate_vocabulary_cache()
+
+
+@pytest.mark.usefixtures("vocab_cache")
+class TestVocabularyCache(object):
+
+    @pytest.mark.ckan_config("ckanext.extrafields.vocab_cache_ttl", "300")
+    def test_tags_are_only_loaded_once(self):
+        with mock.patch.object(plugin, "_load_vocabulary_tags",
+                               return_value=[u"Daily", u"Weekly"]) as load:
+            assert plugin.frequency_codes() == [u"Daily", u"Weekly"]
+            assert plugin.frequency_codes() == [u"Daily", u"Weekly"]
+        load.assert_called_once_with("frequency_codes")
+
+    @pytest.mark.ckan_config("ckanext.extrafields.vocab_cache_ttl", "0")
+    def test_zero_ttl_disables_cache(self):
+        with mock.patch.object(plugin, "_load_vocabulary_tags",
+                               return_value=[u"Daily"]) as load:
+            plugin.frequency_codes()
+            plugin.frequency_codes()
+        assert load.call_count == 2
+
+    @pytest.mark.ckan_config("ckanext.extrafields.vocab_cache_ttl", "300")
+    def test_invalidate_single_vocabulary(self):
+        with mock.patch.object(plugin, "_load_vocabulary_tags",
+                               return_value=[u"Daily"]) as load:
+            plugin.frequency_codes()
+            plugin.geography_codes()
+            plugin.invalidate_vocabulary_cache("frequency_codes")
+            plugin.frequency_codes()
+            plugin.geography_codes()
+        assert [c.args[0] for c in load.call_args_list] == [
+            "frequency_codes", "geography_codes", "frequency_codes"]
+
+    @pytest.mark.ckan_config("ckanext.extrafields.vocab_cache_ttl", "300")
+    def test_tag_create_invalidates_cache(self):
+        with mock.patch.object(plugin, "_load_vocabulary_tags",
+                               return_value=[u"Daily"]) as load:
+            plugin.frequency_codes()
+            original = mock.Mock(return_value={"name": u"Hourly",
+                                               "vocabulary_id": "some-id"})
+            plugin.tag_create(
+                original, {}, {"name": u"Hourly", "vocabulary_id": "some-id"})
+            plugin.frequency_codes()
+        assert load.call_count == 2
+
+
+class TestFacets(object):
+
+    def test_dataset_facets_include_vocabularies(self):
+        facets = plugin.ExampleIDatasetFormPlugin().dataset_facets(
+            {"tags": "Tags"}, "dataset")
+        assert list(facets) == ["tags", "vocab_geography_codes",
+                                "vocab_all_granulatiry_codes",
+                                "vocab_frequency_codes"]
+
+    def test_package_update_invalidates_facet_counts(self):
+        original = mock.Mock(return_value={"id": "some-id"})
+        with mock.patch.object(export, "export_dataset"), \
+                mock.patch.object(plugin.search,
+                                  "invalidate_facet_counts") as invalidate:
+            plugin.package_update(original, {}, {"id": "some-id"})
+        invalidate.assert_called_once_with()
+
+
+class TestDeriveSpatial(object):
+
+    POLYGON = json.dumps({
+        "type": "Feature", "properties": {},
+        "geometry": {"type": "Polygon", "coordinates": [
+            [[-82.8, 27.6], [-82.3, 27.6], [-82.3, 28.2], [-82.8, 28.2],
+             [-82.8, 27.6]]]},
+    })
+
+    def test_derived_fields_are_stored(self):
+        data_dict = plugin.derive_spatial({"spatial": self.POLYGON})
+        assert json.loads(data_dict["spatial_bbox"]) == [
+            -82.8, 27.6, -82.3, 28.2]
+        assert json.loads(data_dict["spatial_centroid"])["coordinates"] == \
+            pytest.approx([-82.55, 27.9])
+        assert json.loads(data_dict["spatial_simplified"])["type"] == \
+            "Polygon"
+
+    def test_plain_text_is_left_alone(self):
+        data_dict = plugin.derive_spatial({
+            "spatial": u"Hillsborough County",
+            "spatial_bbox": "[0, 0, 1, 1]",
+        })
+        assert data_dict == {"spatial": u"Hillsborough County"}
+
+    @pytest.mark.parametrize("value", [
+        '{"type": "Polygon"', '{"type": "Circle", "coordinates": [0, 0]}',
+        '{"type": "Point", "coordinates": ["a", "b"]}'])
+    def test_invalid_geojson_is_rejected(self, value):
+        with pytest.raises(tk.ValidationError) as e:
+            plugin.derive_spatial({"spatial": value})
+        assert "spatial" in e.value.error_dict
+
+    def test_stored_invalid_value_is_kept(self):
+        value = '{"type": "Polygon"'
+        data_dict = plugin.derive_spatial({"spatial": value}, stored=value)
+        assert data_dict == {"spatial": value}
+
+    @pytest.mark.ckan_config("ckan.plugins", "extrafields")
+    @pytest.mark.usefixtures("clean_db", "with_plugins")
+    def test_resource_delete_with_stored_invalid_value(self, shared_dir):
+        dataset = factories.Dataset(resources=[
+            {"url": "http://example.com/2020.csv"},
+            {"url": "http://example.com/2021.csv"}])
+        # Saved before spatial was validated.
+        package = model.Package.get(dataset["id"])
+        package.extras["spatial"] = '{"type": "Polygon"'
+        model.repo.commit()
+
+        helpers.call_action("resource_delete",
+                            id=dataset["resources"][0]["id"])
+
+        result = helpers.call_action("package_show", id=dataset["id"])
+        assert len(result["resources"]) == 1
+        assert result["spatial"] == '{"type": "Polygon"'
+
+    def test_package_create_passes_derived_fields(self):
+        original = mock.Mock(side_effect=lambda context, data_dict: data_dict)
+        with mock.patch.object(export, "export_dataset"):
+            result = plugin.package_create(
+                original, {}, {"name": "test", "spatial": self.POLYGON})
+        assert "spatial_bbox" in original.call_args.args[1]
+        assert result["spatial_bbox"]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "extrafields")
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+class TestVocabulariesEndpoint(object):
+
+    def test_action_returns_every_vocabulary(self):
+        plugin.seed_vocabularies()
+        result = helpers.call_action("extrafields_vocabularies")
+        assert set(result["vocabularies"]) == set(plugin.VOCABULARIES)
+        assert sorted(result["vocabularies"]["resource_year_codes"]) == [
+            str(year) for year in range(2020, 2030)]
+        assert result["hash"] == helpers.call_action(
+            "extrafields_vocabularies")["hash"]
+
+    def test_hash_ignores_tag_order(self):
+        results = []
+        for order in (list, reversed):
+            with mock.patch.object(
+                    plugin, "get_vocabulary_tags",
+                    side_effect=lambda name: list(
+                        order(plugin.VOCABULARIES[name]))):
+                results.append(
+                    helpers.call_action("extrafields_vocabularies"))
+        assert results[0] == results[1]
+        assert results[0]["vocabularies"]["frequency_codes"] == sorted(
+            plugin.VOCABULARIES["frequency_codes"])
+
+    def test_unseeded_vocabularies_fall_back_to_defaults(self):
+        options = plugin.vocabulary_options("census_geo_year_codes")
+        assert [o["value"] for o in options] == [
+            u"2000", u"2010", u"2020", u"2030"]
+
+    def test_etag_and_not_modified(self, app):
+        plugin.seed_vocabularies()
+        url = tk.url_for("extrafields.vocabularies_view")
+
+        response = app.get(url)
+        assert response.status_code == 200
+        assert "max-age=300" in response.headers["Cache-Control"]
+        etag = response.headers["ETag"]
+        assert "frequency_codes" in response.json
+
+        response = app.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+        helpers.call_action("tag_create", name=u"Biweekly",
+                            vocabulary_id="frequency_codes")
+        response = app.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+
+
+@pytest.mark.usefixtures("vocab_cache")
+class TestVocabularyBootstrap(object):
+
+    @pytest.mark.ckan_config("ckanext.extrafields.vocab_cache_ttl", "0")
+    def test_helpers_only_read_tags(self):
+        # Before seeding moved to startup each helper call cost
+        # get_site_user + vocabulary_show + tag_list; now it's one tag_list.
+        tag_list = mock.Mock(return_value=[u"Daily"])
+        with mock.patch.object(plugin.tk, "get_action",
+                               return_value=tag_list) as get_action:
+            plugin.frequency_codes()
+        get_action.assert_called_once_with("tag_list")
+
+    @pytest.mark.usefixtures("clean_db")
+    def test_seed_vocabularies_is_idempotent(self):
+        total = sum(len(tags) for tags in plugin.VOCABULARIES.values())
+        assert plugin.seed_vocabularies() == total
+        assert plugin.seed_vocabularies() == 0
+        for name, tags in plugin.VOCABULARIES.items():
+            assert sorted(
+                plugin.tk.get_action("tag_list")(
+                    data_dict={"vocabulary_id": name})) == sorted(tags)
+
+    @pytest.mark.usefixtures("clean_db")
+    def test_seed_vocabularies_adds_new_tags(self):
+        plugin.seed_vocabularies()
+        tags = plugin.VOCABULARIES["geography_codes"] + (u"Charlotte",)
+        with mock.patch.dict(plugin.VOCABULARIES, {"geography_codes": tags}):
+            assert plugin.seed_vocabularies() == 1
+        assert u"Charlotte" in plugin.tk.get_action("tag_list")(
+            data_dict={"vocabulary_id": "geography_codes"})
+
+
+@pytest.mark.ckan_config("ckan.plugins", "extrafields")
+@pytest.mark.usefixtures("clean_db", "clean_index", "with_plugins")
+class TestBulkUpsert(object):
+
+    def test_creates_updates_and_reports_failures(self, shared_dir):
+        existing = factories.Dataset(title=u"Old Title")
+        datasets = [
+            {"name": "median-income", "title": u"Median Income",
+             "resources": [{"url": "http://example.com/2020.csv",
+                            "resource_year_code": u"2020"}]},
+            {"name": existing["name"], "title": u"New Title"},
+            {"name": "Not A Valid Name!"},
+            {"name": "bad-spatial", "spatial": '{"type": "Polygon"'},
+        ]
+
+        with mock.patch.object(export, "export_dataset",
+                               wraps=export.export_dataset) as export_dataset:
+            result = helpers.call_action("extrafields_bulk_upsert",
+                                         datasets=datasets, chunk_size=3)
+
+        assert (result["created"], result["updated"], result["failed"]) == \
+            (1, 1, 2)
+        assert [r["success"] for r in result["results"]] == [
+            True, True, False, False]
+        assert result["results"][1]["id"] == existing["id"]
+        assert "name" in result["results"][2]["error"]
+        assert "spatial" in result["results"][3]["error"]
+        assert export_dataset.call_count == 2
+
+        assert helpers.call_action(
+            "package_show", id=existing["id"])["title"] == u"New Title"
+        found = helpers.call_action("package_search", q="name:median-income")
+        assert found["count"] == 1
+        assert (shared_dir / "Median_Income__2020.json").exists()
+
+    def test_requires_sysadmin(self):
+        user = factories.User()
+        with pytest.raises(tk.NotAuthorized):
+            helpers.call_action(
+                "extrafields_bulk_upsert",
+                context={"user": user["name"], "ignore_auth": False},
+                datasets=[])
+
+    def test_rejects_bad_input(self):
+        with pytest.raises(tk.ValidationError):
+            helpers.call_action("extrafields_bulk_upsert",
+                                datasets="median-income")
+
+    @pytest.mark.parametrize("chunk_size", ["ten", 0, -1])
+    def test_rejects_bad_chunk_size(self, chunk_size):
+        with pytest.raises(tk.ValidationError) as e:
+            helpers.call_action("extrafields_bulk_upsert", datasets=[],
+                                chunk_size=chunk_size)
+        assert "chunk_size" in e.value.error_dict
+
+    def test_validates_each_dataset_once(self, shared_dir):
+        datasets = [{"name": "first-dataset"}, {"name": "Not Valid!"},
+                    {"name": "second-dataset"}]
+        with mock.patch.object(lib_plugins, "plugin_validate",
+                               wraps=lib_plugins.plugin_validate) as validate:
+            result = helpers.call_action("extrafields_bulk_upsert",
+                                         datasets=datasets)
+
+        assert [r["success"] for r in result["results"]] == [
+            True, False, True]
+        actions = [c.args[4] for c in validate.call_args_list]
+        assert actions.count("package_create") == 3
+        # The invalid dataset didn't roll back the one before it.
+        assert model.Package.get("first-dataset") is not None
+
+    def test_failed_commit_only_fails_its_chunk(self, shared_dir):
+        commit = model.repo.commit
+        calls = []
+
+        def fail_first_commit():
+            calls.append(None)
+            if len(calls) == 1:
+                raise Exception("connection lost")
+            commit()
+
+        datasets = [{"name": "first-dataset"}, {"name": "second-dataset"}]
+        with mock.patch.object(model.repo, "commit", fail_first_commit):
+            result = helpers.call_action("extrafields_bulk_upsert",
+                                         datasets=datasets, chunk_size=1)
+
+        assert (result["created"], result["failed"]) == (1, 1)
+        assert [r["success"] for r in result["results"]] == [False, True]
+        assert "connection lost" in result["results"][0]["error"]["message"]
+        assert model.Package.get("first-dataset") is None
+        assert model.Package.get("second-dataset") is not None
+        found = helpers.call_action("package_search", q="*:*")
+        assert [d["name"] for d in found["results"]] == ["second-dataset"]
+
+
+@pytest.mark.ckan_config("ckan.plugins", "extrafields")
+@pytest.mark.usefixtures("clean_db", "with_plugins")
+class TestDeleteHooks(object):
+
+    def _dataset(self):
+        return factories.Dataset(
+            title=u"Median Income",
+            resources=[{"url": "http://example.com/2020.csv",
+                        "resource_year_code": u"2020"},
+                       {"url": "http://example.com/2021.csv",
+                        "resource_year_code": u"2021"}])
+
+    def test_resource_delete_removes_its_file(self, shared_dir):
+        dataset = self._dataset()
+        assert (shared_dir / "Median_Income__2020.json").exists()
+
+        with mock.patch.object(plugin.tk, "get_action",
+                               wraps=plugin.tk.get_action) as get_action:
+            helpers.call_action(
+                "resource_delete", id=dataset["resources"][0]["id"])
+        assert "package_show" not in [c.args[0]
+                                      for c in get_action.call_args_list]
+
+        assert not (shared_dir / "Median_Income__2020.json").exists()
+        assert (shared_dir / "Median_Income__2021.json").exists()
+
+    def test_package_delete_removes_all_files(self, shared_dir):
+        dataset = self._dataset()
+
+        helpers.call_action("package_delete", id=dataset["name"])
+
+        assert list(shared_dir.glob("*.json")) == []
+
+    def test_unauthorized_delete_keeps_files(self, shared_dir):
+        dataset = self._dataset()
+        user = factories.User()
+
+        with pytest.raises(plugin.tk.NotAuthorized):
+            helpers.call_action(
+                "package_delete",
+                context={"user": user["name"], "ignore_auth": False},
+                id=dataset["id"])
+
+        assert len(list(shared_dir.glob("*.json"))) == 2
+
+
+class TestSchemaCache(object):
+
+    @pytest.mark.parametrize("method", ["create_package_schema",
+                                        "update_package_schema",
+                                        "show_package_schema"])
+    def test_schemas_are_cached_copies(self, method):
+        instance = plugin.ExampleIDatasetFormPlugin()
+        plugin._schema_cache.clear()
+
+        first = getattr(instance, method)()
+        first["resources"]["resource_year_code"].append("changed")
+        second = getattr(instance, method)()
+
+        assert second["resources"]["resource_year_code"] == [
+            plugin.tk.get_validator("ignore_missing")]
+        for field in plugin.EXTRA_FIELDS + tuple(plugin.TAG_FIELDS):
+            assert field in second
+
+    def test_show_schema_adds_free_tags_only_once(self):
+        instance = plugin.ExampleIDatasetFormPlugin()
+        plugin._schema_cache.clear()
+
+        instance.show_package_schema()
+        schema = instance.show_package_schema()
+
+        free_tags_only = plugin.tk.get_converter("free_tags_only")
+        assert schema["tags"]["__extras"].count(free_tags_only) == 1
@@ -0,0 +1,135 @@
+"""Tests for search.py."""
+import json
+from unittest import mock
+
+import pytest
+
+from ckanext.extrafields import search
+
+POLYGON = json.dumps({
+    "type": "Polygon",
+    "coordinates": [[[-82.8, 27.6], [-82.3, 27.6], [-82.3, 28.2],
+                     [-82.8, 28.2], [-82.8, 27.6]]],
+})
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2020-03-01", "2020-03-01T00:00:00Z"),
+    ("2020", "2020-01-01T00:00:00Z"),
+    ("2021-06-30T14:00:00-04:00", "2021-06-30T18:00:00Z"),
+    ("ongoing", None),
+    (None, None),
+])
+def test_to_solr_date(value, expected):
+    assert search.to_solr_date(value) == expected
+
+
+def test_before_index_adds_typed_dates():
+    pkg_dict = search.before_index({
+        "temporal_start": "2020-01-01",
+        "extras_temporal_end": "2020-12-31",
+        "issued": "not a date",
+    })
+
+    assert pkg_dict["temporal_start_date"] == "2020-01-01T00:00:00Z"
+    assert pkg_dict["temporal_end_date"] == "2020-12-31T00:00:00Z"
+    assert "issued_date" not in pkg_dict
+
+
+def test_spatial_is_only_indexed_when_configured():
+    assert "spatial_geom" not in search.before_index({"spatial": POLYGON})
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.solr_spatial_field",
+                         "spatial_geom")
+def test_before_index_adds_spatial_envelope():
+    pkg_dict = search.before_index({"spatial": POLYGON})
+    assert pkg_dict["spatial_geom"] == "ENVELOPE(-82.8, -82.3, 28.2, 27.6)"
+
+    assert "spatial_geom" not in search.before_index({"spatial": "Tampa"})
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.solr_spatial_field",
+                         "spatial_geom")
+@pytest.mark.parametrize("coordinates", ["ab", [1, "b"], [[1]]])
+def test_non_numeric_coordinates_are_not_indexed(coordinates):
+    pkg_dict = search.before_index({
+        "spatial": json.dumps({"type": "Point", "coordinates": coordinates})})
+    assert "spatial_geom" not in pkg_dict
+
+
+def test_before_search_temporal_overlap():
+    params = search.before_search({
+        "fq": "+organization:county",
+        "extras": {"ext_temporal_start": "2020-01-01",
+                   "ext_temporal_end": "2021-01-01"},
+    })
+
+    assert params["fq"] == (
+        "+organization:county "
+        "temporal_start_date:[* TO 2021-01-01T00:00:00Z] "
+        "temporal_end_date:[2020-01-01T00:00:00Z TO *]")
+
+
+def test_before_search_without_temporal_params():
+    assert search.before_search({"q": "income"}) == {"q": "income"}
+
+
+FACET_RESULT = {
+    "count": 3,
+    "results": [],
+    "search_facets": {
+        "vocab_frequency_codes": {"items": [
+            {"name": "Daily", "display_name": "Daily", "count": 2},
+            {"name": "Weekly", "display_name": "Weekly", "count": 1},
+        ]},
+        "vocab_geography_codes": {"items": [
+            {"name": "Manatee", "display_name": "Manatee", "count": 3},
+        ]},
+    },
+}
+
+
+@pytest.fixture
+def package_search():
+    search.invalidate_facet_counts()
+    action = mock.Mock(return_value=FACET_RESULT)
+    with mock.patch.object(search.tk, "get_action", return_value=action):
+        yield action
+    search.invalidate_facet_counts()
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.facet_cache_ttl", "300")
+def test_vocabulary_facet_counts(package_search):
+    vocabularies = ("geography_codes", "frequency_codes", "empty_codes")
+
+    counts = search.vocabulary_facet_counts(vocabularies)
+    assert counts == {
+        "geography_codes": {"Manatee": 3},
+        "frequency_codes": {"Daily": 2, "Weekly": 1},
+        "empty_codes": {},
+    }
+    counts["geography_codes"]["Manatee"] = 0
+    assert search.vocabulary_facet_counts(vocabularies)[
+        "geography_codes"] == {"Manatee": 3}
+
+    package_search.assert_called_once()
+    data_dict = package_search.call_args.args[1]
+    assert data_dict["rows"] == 0
+    assert json.loads(data_dict["facet.field"]) == [
+        "vocab_geography_codes", "vocab_frequency_codes", "vocab_empty_codes"]
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.facet_cache_ttl", "300")
+def test_invalidate_facet_counts(package_search):
+    search.vocabulary_facet_counts(["frequency_codes"])
+    search.invalidate_facet_counts()
+    search.vocabulary_facet_counts(["frequency_codes"])
+    assert package_search.call_count == 2
+
+
+@pytest.mark.ckan_config("ckanext.extrafields.facet_cache_ttl", "0")
+def test_zero_facet_ttl_disables_cache(package_search):
+    search.vocabulary_facet_counts(["frequency_codes"])
+    search.vocabulary_facet_counts(["frequency_codes"])
+    assert package_search.call_count == 2
@@ -0,0 +1,68 @@
+"""Tests for spatial.py."""
+import json
+import math
+
+import pytest
+
+from ckanext.extrafields import spatial
+
+SQUARE = {"type": "Polygon",
+          "coordinates": [[[0, 0], [4, 0], [4, 4], [0, 4], [0, 0]]]}
+
+
+def test_centroid_of_polygon_with_hole():
+    polygon = {"type": "Polygon", "coordinates": [
+        SQUARE["coordinates"][0],
+        # Hole in the right half, wound the other way.
+        [[2, 0], [2, 4], [4, 4], [4, 0], [2, 0]],
+    ]}
+    assert spatial.centroid(SQUARE) == pytest.approx((2, 2))
+    assert spatial.centroid(polygon) == pytest.approx((1, 2))
+
+
+def test_centroid_without_area():
+    line = {"type": "LineString", "coordinates": [[0, 0], [2, 4]]}
+    assert spatial.centroid(line) == pytest.approx((1, 2))
+
+
+def test_simplify_drops_points_within_tolerance():
+    line = {"type": "LineString", "coordinates": [
+        [0, 0], [1, 0.0001], [2, -0.0001], [3, 5], [4, 0]]}
+    assert spatial.simplify(line, 0.001)["coordinates"] == [
+        [0, 0], [2, -0.0001], [3, 5], [4, 0]]
+
+
+def test_simplify_keeps_polygon_outline():
+    circle = [[math.cos(a / 100.0 * 2 * math.pi),
+               math.sin(a / 100.0 * 2 * math.pi)] for a in range(100)]
+    circle.append(circle[0])
+    polygon = {"type": "MultiPolygon", "coordinates": [
+        [circle, [[0, 0], [0.0001, 0], [0, 0.0001], [0, 0]]]]}
+
+    simplified = spatial.simplify(polygon, 0.01)
+    rings = simplified["coordinates"][0]
+    assert len(rings) == 1
+    assert 4 <= len(rings[0]) < len(circle)
+    assert rings[0][0] == rings[0][-1]
+
+    # A tolerance larger than the shape can't make it disappear.
+    assert spatial.simplify(polygon, 10)["coordinates"][0][0] == circle
+
+
+def test_derived_fields():
+    fields = spatial.derived_fields(spatial.parse_geometry(SQUARE), 0.001)
+    assert json.loads(fields["spatial_bbox"]) == [0, 0, 4, 4]
+    assert json.loads(fields["spatial_centroid"]) == {
+        "type": "Point", "coordinates": [2, 2]}
+    assert json.loads(fields["spatial_simplified"]) == SQUARE
+
+
+def test_derived_fields_of_invalid_geometry():
+    assert spatial.derived_fields(None, 0.001) is None
+
+
+def test_non_numeric_coordinates_have_no_bbox():
+    geometry = spatial.parse_geometry(
+        {"type": "Point", "coordinates": ["a", "b"]})
+    assert spatial.bbox(geometry) is None
+    assert spatial.derived_fields(geometry, 0.001) is None
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from flask import Blueprint, Response, request
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.extrafields import metrics
+
+
+extrafields = Blueprint(u'extrafields', __name__)
+
+
+def metrics_view():
+    """Prometheus scrape endpoint for this worker's metrics."""
+    if not tk.asbool(tk.config.get(
+            u'ckanext.extrafields.metrics_endpoint', False)):
+        return tk.abort(404)
+    return Response(metrics.render_prometheus(),
+                    mimetype=u'text/plain; version=0.0.4')
+
+
+DEFAULT_VOCABULARIES_MAX_AGE = 300
+
+
+def vocabularies_view():
+    """All the extension's vocabularies, cacheable by browsers and proxies.
+
+    The ETag is the vocabularies' content hash, so a client that sends it
+    back in If-None-Match gets an empty 304 until a tag changes.
+    """
+    result = tk.get_action(u'extrafields_vocabularies')({}, {})
+    max_age = tk.asint(tk.config.get(
+        u'ckanext.extrafields.vocabularies_max_age',
+        DEFAULT_VOCABULARIES_MAX_AGE))
+    if result[u'hash'] in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(json.dumps(result[u'vocabularies']),
+                            mimetype=u'application/json')
+    response.set_etag(result[u'hash'])
+    response.headers[u'Cache-Control'] = u'public, max-age={}'.format(
+        max_age)
+    return response
+
+
+extrafields.add_url_rule(u'/extrafields/metrics', view_func=metrics_view)
+extrafields.add_url_rule(u'/extrafields/vocabularies',
+                         view_func=vocabularies_view)
+
+
+def get_blueprints():
+    return [extrafields]